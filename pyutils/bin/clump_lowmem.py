@@ -23,6 +23,9 @@ import stat
 import shutil
 import optparse
 import tempfile
+import multiprocessing
+import collections
+from osgeo import gdal
 from rios import applier, cuiprogress
 import numpy
 from numba import autojit
@@ -41,6 +44,9 @@ class CmdArgs(object):
         self.parser.add_option('-t', '--tempdir', dest='tempdir',
             default='.',
             help="Temp directory to use (default=%default)")
+        self.parser.add_option('-n', '--numprocs', dest='numprocs',
+            default=1, type='int',
+            help="Number of processes to clump the tiles with (default=%default)")
 
         (options, self.args) = self.parser.parse_args()
         self.__dict__.update(options.__dict__)
@@ -52,129 +58,209 @@ class CmdArgs(object):
 def riosClump(info, inputs, outputs, otherinputs):
     """
     Called from RIOS - clumps each individual tile separately
-    (but with globally unique ids)
+    (but with globally unique ids) and records which clumps
+    touch clumps in the tiles above and to the left
     """
-    # create valid mask that is True where data!=ignore
-    ignore = info.getNoDataValueFor(inputs.infile)
-    if ignore is not None:
-        valid = inputs.infile[0] != ignore
+    if otherinputs.tileResults is None:
+        # create valid mask that is True where data!=ignore
+        ignore = info.getNoDataValueFor(inputs.infile)
+        if ignore is not None:
+            valid = inputs.infile[0] != ignore
+        else:
+            # no ignore val set - all valid
+            valid = numpy.ones_like(inputs.infile[0], dtype=bool)
+
+        out, clumpId = mdl.clump(inputs.infile[0], valid, otherinputs.clumpId)
     else:
-        # no ignore val set - all valid
-        valid = numpy.ones_like(inputs.infile[0], dtype=numpy.bool)
+        # already clumped by clumpTile() in a worker with ids from 1
+        # the tiles come back in the same order RIOS reads them
+        out, nClumps = next(otherinputs.tileResults)
+        if out.shape != inputs.infile[0].shape:
+            raise ValueError('Tile from worker does not match RIOS block')
+        # shift into the global id space. clumpId is the running
+        # (prefix) sum of the clump counts of the tiles before this one
+        numpy.add(out, otherinputs.clumpId - 1, out=out, where=(out != 0))
+        clumpId = otherinputs.clumpId + nClumps
+
+    # make sure the equivalence table has an entry for each new clump
+    otherinputs.parent = growParent(otherinputs.parent, clumpId)
+    recordEdges(info, inputs.infile[0], out, otherinputs)
+
+    outputs.outfile = mdl.makestack([out], copy=False)
+    otherinputs.clumpId = clumpId
 
-    out, clumpId = mdl.clump(inputs.infile[0], valid, otherinputs.clumpId)
+def clumpTile(tile):
+    """
+    Called in a worker process - reads and clumps a single tile 
+    with ids starting at 1. tile is a tuple of 
+    (infile, xoff, yoff, xsize, ysize).
+    Returns the clumps and the number of clumps found.
+    """
+    (infile, xoff, yoff, xsize, ysize) = tile
+    ds = gdal.Open(infile)
+    band = ds.GetRasterBand(1)
+    data = band.ReadAsArray(xoff, yoff, xsize, ysize)
 
-    outputs.outfile = mdl.makestack([out])
-    otherinputs.clumpId = clumpId
+    ignore = band.GetNoDataValue()
+    if ignore is not None:
+        valid = data != ignore
+    else:
+        valid = numpy.ones_like(data, dtype=bool)
 
-@autojit
-def recodeInternal(clump, oldvalue, newvalue):
-    ysize, xsize = clump.shape
-    for y in range(ysize):
-        for x in range(xsize):
-            value = clump[y, x]
-            if value == oldvalue:
-                clump[y, x] = newvalue
+    out, clumpId = mdl.clump(data, valid)
+    return out, clumpId - 1
+
+def boundedTileResults(pool, tiles, maxPending):
+    """
+    Generator which clumps the tiles in the pool and yields the
+    results in order. No more than maxPending tiles are queued in
+    the pool at once, so clumped tiles don't pile up in memory 
+    faster than RIOS can write them out.
+    """
+    tiles = iter(tiles)
+    pending = collections.deque()
+    for tile in tiles:
+        pending.append(pool.apply_async(clumpTile, (tile,)))
+        if len(pending) >= maxPending:
+            break
+    while len(pending) > 0:
+        result = pending.popleft().get()
+        # top up the queue before handing the result over
+        for tile in tiles:
+            pending.append(pool.apply_async(clumpTile, (tile,)))
+            break
+        yield result
+
+def getTiles(infile, controls):
+    """
+    Returns a list of (infile, xoff, yoff, xsize, ysize) tuples, one
+    for each block RIOS will read from infile, in the same order.
+    """
+    ds = gdal.Open(infile)
+    xtotal = ds.RasterXSize
+    ytotal = ds.RasterYSize
+    del ds
+
+    tiles = []
+    for yoff in range(0, ytotal, controls.windowysize):
+        ysize = min(controls.windowysize, ytotal - yoff)
+        for xoff in range(0, xtotal, controls.windowxsize):
+            xsize = min(controls.windowxsize, xtotal - xoff)
+            tiles.append((infile, xoff, yoff, xsize, ysize))
+    return tiles
+
+def growParent(parent, size):
+    """
+    Returns the disjoint-set table grown (if needed) so it has
+    at least size entries. New entries are their own parent.
+    Grows by doubling so we don't copy on every tile.
+    """
+    if size <= parent.size:
+        return parent
+    newparent = numpy.arange(max(size, parent.size * 2), dtype=numpy.uint32)
+    newparent[:parent.size] = parent
+    return newparent
 
 @autojit
-def mergeInternal(clump, recode, dontrecode, thisy, thisx, othery, otherx):
+def findRoot(parent, clumpId):
     """
-    This was a closure of numbaMerge until it seemed there was a big
-    memory leak. This seems to work much better.
+    Find the root of clumpId in the disjoint-set table,
+    halving the path as we go.
     """
-    thisClumpId = clump[thisy, thisx]
-    otherClumpId = clump[othery, otherx]
-    # don't bother if they already have the same id 
-    # and don't bother recoding 0's
-    if (thisClumpId != otherClumpId and thisClumpId != 0 and 
-            otherClumpId != 0):
-        if not dontrecode[otherClumpId]:
-            # only if this one isn't marked to be recoded
-            recode[otherClumpId] = recode[thisClumpId]
-            # recode while we go
-            recodeInternal(clump, otherClumpId, thisClumpId)
-            # mark as not to be recoded
-            dontrecode[thisClumpId] = True
-        elif not dontrecode[thisClumpId]:
-            # ok try the other way around
-            recode[thisClumpId] = recode[otherClumpId]
-            recodeInternal(clump, thisClumpId, otherClumpId)
-            dontrecode[otherClumpId] = True
-        else:
-            # need to re run the whole thing
-            # both are marked as un-recodable
-            return 1
-    return 0
+    while parent[clumpId] != clumpId:
+        parent[clumpId] = parent[parent[clumpId]]
+        clumpId = parent[clumpId]
+    return clumpId
 
 @autojit
-def numbaMerge(infile, clump, recode, dontrecode, processBottom, processRight):
+def unionEdge(parent, thisVals, thisClumps, otherVals, otherClumps):
     """
-    Merge the clumps using a slightly complicated algorithm
+    Merge the clumps along a shared tile edge. thisVals and 
+    otherVals are the DNs either side of the edge and thisClumps 
+    and otherClumps the matching clump ids. The root with the 
+    lower id always wins so every entry points to an id 
+    no greater than its own.
     """
-    ysize, xsize = infile.shape
-    nFailedRecodes = 0
-    thisx = 0
-    otherx = 0
-    thisy = 0
-    othery = 0
-
-    if processBottom:
-        # this isn't the bottom most block so run along the bottom
-        # 2 lines and decide if clumps need to be merged
-        thisy = ysize - 2
-        othery = ysize - 1
-        # start one pixel in and finish one pixel in
-        for thisx in range(0, xsize-1):
-            otherx = thisx
-            if infile[thisy, thisx] == infile[othery, otherx]:
-                # they should be the same clump - they have the same DNs
-                nFailedRecodes += mergeInternal(clump, recode, dontrecode, 
-                                    thisy, thisx, othery, otherx)
-
-    # same for the right hand margin if we aren't the rightmost block
-    if processRight:
-        thisx = xsize - 2
-        otherx = xsize - 1
-        for thisy in range(0, ysize-1):
-            othery = thisy
-            if infile[thisy, thisx] == infile[othery, otherx]:
-                # they should be the same clump
-                nFailedRecodes += mergeInternal(clump, recode, dontrecode, 
-                                    thisy, thisx, othery, otherx)
-
-    return nFailedRecodes
-
-def riosMerge(info, inputs, outputs, otherinputs):
+    for i in range(thisVals.shape[0]):
+        thisClumpId = thisClumps[i]
+        otherClumpId = otherClumps[i]
+        # don't bother recoding 0's
+        if (thisClumpId != 0 and otherClumpId != 0 and 
+                thisVals[i] == otherVals[i]):
+            thisRoot = findRoot(parent, thisClumpId)
+            otherRoot = findRoot(parent, otherClumpId)
+            if thisRoot < otherRoot:
+                parent[otherRoot] = thisRoot
+            elif otherRoot < thisRoot:
+                parent[thisRoot] = otherRoot
+
+def recordEdges(info, data, clump, otherinputs):
     """
-    Determine which clumps need to be merged
-    and update otherinputs.recode
+    Merge the clumps along the top edge of this tile with the
+    bottom row of the tile above, and along the left edge with
+    the right column of the tile to the left. Then save this
+    tile's bottom row and right column for the tiles still to come.
+    Only one image row and one tile column of edges is kept.
     """
-    # overlap is set to one
-    # we only need to inspect the right and bottom edge
-    # and only if we aren't rightmost or bottom most
     xblock, yblock = info.getBlockCount()
-    xtotalblocks, ytotalblocks = info.getTotalBlocks()
-    processBottom = yblock != (ytotalblocks-1)
-    processRight = xblock != (xtotalblocks-1)
-
-    # recode this clump with the up to date recode table
-    # so we are working with the right clumpids
-    clump = otherinputs.recode[inputs.tileclump[0]]
+    col, row = info.getPixColRow(0, 0)
+    ysize, xsize = data.shape
+
+    if otherinputs.rowVals is None:
+        xtotal, ytotal = info.getTotalSize()
+        otherinputs.rowVals = numpy.zeros((xtotal,), dtype=data.dtype)
+        otherinputs.rowClumps = numpy.zeros((xtotal,), dtype=numpy.uint32)
+
+    rowVals = otherinputs.rowVals[col:col+xsize]
+    rowClumps = otherinputs.rowClumps[col:col+xsize]
+    if yblock > 0:
+        unionEdge(otherinputs.parent, data[0], clump[0], rowVals, rowClumps)
+    if xblock > 0:
+        unionEdge(otherinputs.parent, data[:, 0], clump[:, 0], 
+                otherinputs.colVals, otherinputs.colClumps)
+
+    rowVals[:] = data[-1]
+    rowClumps[:] = clump[-1]
+    otherinputs.colVals = data[:, -1].copy()
+    otherinputs.colClumps = clump[:, -1].copy()
 
-    # merge the clumps (updates clump, otherinputs.recode
-    # and otherinputs.dontrecode)
-    nFailedRecodes = numbaMerge(inputs.infile[0], clump, 
-            otherinputs.recode, otherinputs.dontrecode, processBottom, processRight)
-
-    # keep a track
-    otherinputs.nFailedRecodes += nFailedRecodes
+@autojit
+def flattenParent(parent, nIds):
+    """
+    Point every entry in the disjoint-set table directly at its root.
+    Since parents always have a lower id a single pass in 
+    increasing order is enough.
+    """
+    for clumpId in range(1, nIds):
+        parent[clumpId] = parent[parent[clumpId]]
 
-    # output the merged clumps
-    outputs.clump = mdl.makestack([clump])
+def resolveLabels(parent, nIds):
+    """
+    Turn the disjoint-set table into a recode table that maps the
+    per tile clump ids to the final clump ids. The final ids are
+    numbered consecutively from 1 with 0 left as no data.
+    """
+    parent = parent[:nIds]
+    flattenParent(parent, nIds)
+    isRoot = parent == numpy.arange(nIds, dtype=numpy.uint32)
+    isRoot[0] = False
+    newIds = isRoot.cumsum(dtype=numpy.uint32)
+    return newIds[parent]
+
+def riosRecode(info, inputs, outputs, otherinputs):
+    """
+    Apply the global recode table to the tile clumps
+    """
+    clump = otherinputs.recode[inputs.tileclump[0]]
+    outputs.clump = mdl.makestack([clump], copy=False)
 
-def doClump(infile, outfile, tempDir):
+def doClump(infile, outfile, tempDir, numProcs=1):
     """
-    Do the clumping
+    Do the clumping. First pass clumps each tile and records which 
+    clumps meet across tile edges in a disjoint-set table, second 
+    pass writes out the final clump ids.
+    If numProcs is greater than 1 the tiles in the first pass are
+    clumped in a pool of that many processes.
     """
     inputs = applier.FilenameAssociations()
     inputs.infile = infile
@@ -188,61 +274,59 @@ def doClump(infile, outfile, tempDir):
     # start at clumpid 1 - will be zeros where no data
     otherinputs = applier.OtherInputs()
     otherinputs.clumpId = 1
+    otherinputs.parent = numpy.arange(1024, dtype=numpy.uint32)
+    # edges from the previous tiles - created on the first tile
+    otherinputs.rowVals = None
+    otherinputs.rowClumps = None
+    otherinputs.colVals = None
+    otherinputs.colClumps = None
 
     controls = applier.ApplierControls()
     controls.progress = cuiprogress.GDALProgressBar()
     # don't need stats for this since it is just temporary
     controls.calcStats = False
 
-    applier.apply(riosClump, inputs, outputs, otherinputs, controls=controls)
+    if numProcs > 1:
+        pool = multiprocessing.Pool(numProcs)
+        try:
+            otherinputs.tileResults = boundedTileResults(pool, 
+                    getTiles(infile, controls), 2 * numProcs)
+            applier.apply(riosClump, inputs, outputs, otherinputs, 
+                    controls=controls)
+        finally:
+            # don't leave workers running if RIOS raised
+            pool.terminate()
+            pool.join()
+            otherinputs.tileResults = None
+    else:
+        otherinputs.tileResults = None
+        applier.apply(riosClump, inputs, outputs, otherinputs, controls=controls)
+
+    otherinputs.recode = resolveLabels(otherinputs.parent, otherinputs.clumpId)
+    # free the tables we don't need any more
+    otherinputs.parent = None
+    otherinputs.rowVals = None
+    otherinputs.rowClumps = None
 
-    # run it on the input image again, but also read in the tile clumps
+    # now read the tile clumps back in and write the final ids
+    inputs = applier.FilenameAssociations()
     inputs.tileclump = tmpClump
 
-    # overlap of 1 so we can work out which neighbouring
-    # clumps need to be merged
-    controls.overlap = 1
     # make thematic
-    # but still don't do stats - only when we finally know we succeeded
+    # but still don't do stats - done below
     controls.thematic = True
 
+    # it creates the output file as it goes
+    # just create temp at this stage until we know it has succeeded
     outputs = applier.FilenameAssociations()
+    fileh, tmpMerged = tempfile.mkstemp('.kea', dir=tempDir)
+    os.close(fileh)
+    outputs.clump = tmpMerged
 
-    finished = False
-    while not finished:
-
-        # it creates the output file as it goes
-        # just create temp at this stage until we know it has succeeded
-        fileh, tmpMerged = tempfile.mkstemp('.kea', dir=tempDir)
-        os.close(fileh)
-
-        outputs.clump = tmpMerged
-
-        otherinputs.nFailedRecodes = 0
-        # ok now we have to merge the clumps
-        # create a recode table
-        recode = numpy.arange(otherinputs.clumpId, dtype=numpy.uint32)    
-        otherinputs.recode = recode
-
-        # create a boolean array with clumps not to recode
-        # obviously if you recode 39 -> 23 you don't want 23 being recoded to 
-        # something else
-        dontrecode = numpy.zeros_like(recode, dtype=numpy.bool)
-        otherinputs.dontrecode = dontrecode
-
-        applier.apply(riosMerge, inputs, outputs, otherinputs, controls=controls)
-
-        # clobber the last temp input
-        os.remove(inputs.tileclump)
-
-        inputs.tileclump = tmpMerged
+    applier.apply(riosRecode, inputs, outputs, otherinputs, controls=controls)
 
-        dontrecodesum = dontrecode.sum()
-        finished = dontrecodesum == 0
-        if not finished:
-            print('%d clumps failed to merge. %d recoded' % (
-                        otherinputs.nFailedRecodes, dontrecodesum))
-            print('having another go')
+    # clobber the temp input
+    os.remove(tmpClump)
 
     # now we save the final output as the output name and calc stats
     cmd = 'gdalcalcstats %s -ignore 0' % tmpMerged
@@ -266,5 +350,6 @@ def doClump(infile, outfile, tempDir):
 if __name__ == '__main__':
     cmdargs = CmdArgs()
 
-    doClump(cmdargs.infile, cmdargs.output, cmdargs.tempdir)
+    doClump(cmdargs.infile, cmdargs.output, cmdargs.tempdir, 
+                cmdargs.numprocs)
     
@@ -51,6 +51,26 @@ class CmdArgs(object):
         self.parser.add_option('-b', '--bands', dest='bands',
                     help="comma separated list of 1-based bands to use. "+
                         "Default is all bands")
+        self.parser.add_option('-e', '--exact', action="store_true",
+                    default=False, dest="exact",
+                    help="If set, all the values are held in memory so the"+
+                        " median of non-integer rasters is exact. The"+
+                        " default is to use a quantile sketch")
+        self.parser.add_option('-n', '--numprocs', dest='numprocs',
+                    default=1, type='int',
+                    help="Number of processes to use, not used with"+
+                        " --perfeature (default=%default)")
+        self.parser.add_option('-f', '--perfeature', action="store_true",
+                    default=False, dest="perfeature",
+                    help="If set, output the stats for each feature"+
+                        " separately, prefixed by the FID (or --keyfield)")
+        self.parser.add_option('-k', '--keyfield', dest='keyfield',
+                    help="Attribute to key the per feature stats on."+
+                        " Default is the FID")
+        self.parser.add_option('-w', '--windowed', action="store_true",
+                    default=False, dest="windowed",
+                    help="If set with --perfeature, features are grouped"+
+                        " and only the raster under each group is read")
 
         (options, self.args) = self.parser.parse_args()
         self.__dict__.update(options.__dict__)
@@ -81,12 +101,26 @@ if __name__ == '__main__':
         if len(ignore_values) == 1:
             ignore_values = ignore_values[0]
 
-    results = vectorstats.doStats(cmdargs.vector, cmdargs.raster, 
+    if cmdargs.perfeature:
+        featureResults = vectorstats.doStatsPerFeature(cmdargs.vector, 
+                    cmdargs.raster, ignore_behaviour, ignore_values, 
+                    cmdargs.sql, cmdargs.alltouched, bands, cmdargs.layer,
+                    cmdargs.keyfield, windowed=cmdargs.windowed)
+        for key in featureResults.keys():
+            results = featureResults[key]
+            for band in sorted(results.keys()):
+                print('%s %d %f %f %f %f %f %d' % (key, band, 
+                    results[band]['mean'], results[band]['median'],  
+                    results[band]['std'], results[band]['min'],  
+                    results[band]['max'], results[band]['count']))
+    else:
+        results = vectorstats.doStats(cmdargs.vector, cmdargs.raster, 
                     ignore_behaviour, ignore_values, cmdargs.sql, 
-                    cmdargs.alltouched, bands, cmdargs.layer)
+                    cmdargs.alltouched, bands, cmdargs.layer, cmdargs.exact,
+                    numProcs=cmdargs.numprocs)
 
-    for band in sorted(results.keys()):
-        print('%d %f %f %f %f %f %d' % (band, results[band]['mean'],
-            results[band]['median'],  results[band]['std'],
-             results[band]['min'],  results[band]['max'], 
-                results[band]['count']))
+        for band in sorted(results.keys()):
+            print('%d %f %f %f %f %f %d' % (band, results[band]['mean'],
+                results[band]['median'],  results[band]['std'],
+                 results[band]['min'],  results[band]['max'], 
+                    results[band]['count']))
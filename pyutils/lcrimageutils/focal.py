@@ -0,0 +1,541 @@
+"""
+Focal (neighbourhood) operations on images, similar to the Focal
+functions in Imagine Spatial Modeller.
+
+All the operations take a radius, in pixels, and work on a window
+of (2 * radius + 1) pixels square (or the circle from
+mdl.makeBufferKernel() for the circular versions). Where the window
+runs off the edge of the array only the pixels inside it are used.
+
+Each operation records the overlap it needs when called from RIOS
+as a function attribute, so for example::
+
+    controls.setOverlap(focal.focalMean.overlap(radius))
+
+RIOS fills the overlap at the edge of the image with the null value,
+so pass that as ignoreVal to exclude it.
+
+The sums and means use running sums, and the square max and min use
+the van Herk/Gil-Werman algorithm, so they cost about the same
+regardless of the radius. The circular max and min do one such pass
+per row of the circle, so their cost grows with the radius rather
+than its square. The majority filter updates a histogram as the window
+moves so its cost also grows with the radius rather than its square.
+The buffer uses an exact Euclidean distance transform so its cost
+doesn't depend on the radius either.
+
+"""
+# This file is part of 'gdalutils'
+# Copyright (C) 2014 Sam Gillingham
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import numpy
+from .mdl import jit, MdlFuncError, makeBufferKernel
+
+class FocalError(MdlFuncError):
+    pass
+
+# the majority filter finds the distinct values of integer images with
+# a bincount if the range of values is no more than this, otherwise
+# by sorting
+MAJORITY_DENSE_MAX = 2**16
+
+def _checkArgs(img, radius):
+    """
+    Checks the image and radius passed to one of the focal functions
+    """
+    if img.ndim < 2:
+        raise FocalError("Input must be an image (2d) or image stack (3d)")
+    if int(radius) != radius or radius < 0:
+        raise FocalError("Radius must be a non-negative integer")
+
+def _validMask(img, ignoreVal):
+    """
+    Returns a boolean array of the pixels not equal to ignoreVal,
+    or None if ignoreVal is None
+    """
+    if ignoreVal is None:
+        return None
+    return img != ignoreVal
+
+def _boxSum(a, radius, axis, dtype):
+    """
+    Sum of a over a window of radius pixels either side along axis,
+    truncated at the edges. Uses the difference of a cumulative sum
+    so the cost doesn't depend on the radius.
+    """
+    a = numpy.moveaxis(a, axis, -1)
+    n = a.shape[-1]
+    cumSum = numpy.zeros(a.shape[:-1] + (n + 1,), dtype=dtype)
+    numpy.cumsum(a, axis=-1, dtype=dtype, out=cumSum[..., 1:])
+    idx = numpy.arange(n)
+    upper = numpy.minimum(idx + radius + 1, n)
+    lower = numpy.maximum(idx - radius, 0)
+    out = cumSum[..., upper] - cumSum[..., lower]
+    return numpy.moveaxis(out, -1, axis)
+
+def _extremeFill(dtype, ufunc):
+    """
+    The value that has no effect when combined by ufunc
+    (numpy.maximum or numpy.minimum) for the given dtype
+    """
+    isMax = ufunc is numpy.maximum
+    if dtype == numpy.bool_:
+        return not isMax
+    elif numpy.issubdtype(dtype, numpy.floating):
+        return -numpy.inf if isMax else numpy.inf
+    else:
+        info = numpy.iinfo(dtype)
+        return info.min if isMax else info.max
+
+def _slidingExtreme(a, radius, axis, ufunc):
+    """
+    Max or min (depending on ufunc) of a over a window of radius
+    pixels either side along axis, truncated at the edges.
+
+    Uses the van Herk/Gil-Werman algorithm - the padded array is split
+    into blocks the size of the window and running extremes are
+    accumulated forwards and backwards within each block. Any window
+    then spans at most two blocks so its extreme is the combination of
+    one value from each.
+    """
+    if radius == 0:
+        return a.copy()
+    a = numpy.moveaxis(a, axis, -1)
+    n = a.shape[-1]
+    size = 2 * radius + 1
+    nBlocks = (n + 2 * radius + size - 1) // size
+
+    padded = numpy.empty(a.shape[:-1] + (nBlocks * size,), dtype=a.dtype)
+    padded.fill(_extremeFill(a.dtype, ufunc))
+    padded[..., radius:radius+n] = a
+    blocks = padded.reshape(a.shape[:-1] + (nBlocks, size))
+
+    forward = ufunc.accumulate(blocks, axis=-1).reshape(padded.shape)
+    backward = ufunc.accumulate(blocks[..., ::-1], axis=-1)[..., ::-1]
+    backward = backward.reshape(padded.shape)
+
+    out = ufunc(backward[..., :n], forward[..., size-1:size-1+n])
+    return numpy.moveaxis(out, -1, axis)
+
+def _circleHalfWidths(radius):
+    """
+    Returns an array of the half widths of each row of the circular
+    kernel of the given radius, from mdl.makeBufferKernel().
+    """
+    if radius == 0:
+        return numpy.zeros((1,), dtype=int)
+    kernel = makeBufferKernel(radius)
+    return kernel.sum(axis=1) // 2
+
+def _circularExtreme(a, radius, ufunc):
+    """
+    Max or min of a over the circular kernel of the given radius.
+    The circle is split into one horizontal line per kernel row, so
+    this is done as a 1d sliding extreme along the rows for each
+    distinct line length, shifted up or down and combined.
+    """
+    halfWidths = _circleHalfWidths(radius)
+    nrows = a.shape[-2]
+    out = _slidingExtreme(a, int(halfWidths[radius]), -1, ufunc)
+    rowExtremes = {}
+    for dy in range(1, min(radius, nrows - 1) + 1):
+        halfWidth = int(halfWidths[radius + dy])
+        if halfWidth not in rowExtremes:
+            rowExtremes[halfWidth] = _slidingExtreme(a, halfWidth, -1, ufunc)
+        rowExtreme = rowExtremes[halfWidth]
+        # the rows dy below and dy above
+        ufunc(out[..., :nrows-dy, :], rowExtreme[..., dy:, :],
+                    out=out[..., :nrows-dy, :])
+        ufunc(out[..., dy:, :], rowExtreme[..., :nrows-dy, :],
+                    out=out[..., dy:, :])
+    return out
+
+def _focalExtreme(img, radius, circular, ignoreVal, outputNullVal, ufunc):
+    """
+    Shared code for focalMax() and focalMin()
+    """
+    _checkArgs(img, radius)
+    radius = int(radius)
+    valid = _validMask(img, ignoreVal)
+    if valid is not None:
+        img = numpy.where(valid, img, _extremeFill(img.dtype, ufunc))
+
+    if circular:
+        out = _circularExtreme(img, radius, ufunc)
+    else:
+        out = _slidingExtreme(img, radius, -1, ufunc)
+        out = _slidingExtreme(out, radius, -2, ufunc)
+
+    if valid is not None:
+        # windows which had no valid pixels
+        if circular:
+            anyValid = _circularExtreme(valid, radius, numpy.maximum)
+        else:
+            anyValid = _slidingExtreme(valid, radius, -1, numpy.maximum)
+            anyValid = _slidingExtreme(anyValid, radius, -2, numpy.maximum)
+        out[~anyValid] = outputNullVal
+    return out
+
+def focalMax(img, radius, circular=False, ignoreVal=None, outputNullVal=0):
+    """
+    Returns the maximum of the pixels within radius of each pixel.
+    If circular is True the window is the circle from
+    mdl.makeBufferKernel(radius), otherwise it is square.
+    Pixels equal to ignoreVal are not used, and outputNullVal
+    is returned where there are no other pixels in the window.
+    img may be a single image (2d) or a stack (3d), and the result
+    has the same shape and type.
+    """
+    return _focalExtreme(img, radius, circular, ignoreVal, outputNullVal,
+                numpy.maximum)
+
+def focalMin(img, radius, circular=False, ignoreVal=None, outputNullVal=0):
+    """
+    Returns the minimum of the pixels within radius of each pixel.
+    Arguments are the same as for focalMax().
+    """
+    return _focalExtreme(img, radius, circular, ignoreVal, outputNullVal,
+                numpy.minimum)
+
+def focalSum(img, radius, ignoreVal=None):
+    """
+    Returns the sum of the pixels in the square window within radius
+    of each pixel, ignoring pixels equal to ignoreVal. Integer images
+    are summed as 64 bit integers so the result is exact, otherwise
+    as 64 bit floats. img may be a single image (2d) or a stack (3d).
+    """
+    _checkArgs(img, radius)
+    radius = int(radius)
+    if numpy.issubdtype(img.dtype, numpy.floating):
+        sumType = numpy.float64
+    else:
+        sumType = numpy.int64
+    valid = _validMask(img, ignoreVal)
+    if valid is not None:
+        img = numpy.where(valid, img, 0)
+
+    out = _boxSum(img, radius, -1, sumType)
+    return _boxSum(out, radius, -2, sumType)
+
+def focalCount(img, radius, ignoreVal=None):
+    """
+    Returns the number of pixels in the square window within radius
+    of each pixel that are not equal to ignoreVal. This is less than
+    the size of the window near the edges of the array.
+    """
+    _checkArgs(img, radius)
+    radius = int(radius)
+    valid = _validMask(img, ignoreVal)
+    if valid is None:
+        # only depends on the distance from the edges
+        shape = img.shape
+        rowCount = _boxSum(numpy.ones((1, shape[-1]), dtype=numpy.int64),
+                        radius, -1, numpy.int64)
+        colCount = _boxSum(numpy.ones((shape[-2], 1), dtype=numpy.int64),
+                        radius, -2, numpy.int64)
+        return numpy.broadcast_to(colCount * rowCount, shape).copy()
+
+    out = _boxSum(valid, radius, -1, numpy.int64)
+    return _boxSum(out, radius, -2, numpy.int64)
+
+def focalMean(img, radius, ignoreVal=None, outputNullVal=0):
+    """
+    Returns the mean of the pixels in the square window within radius
+    of each pixel as 64 bit floats. Pixels equal to ignoreVal are not
+    used, and outputNullVal is returned where there are no other pixels
+    in the window. img may be a single image (2d) or a stack (3d).
+    """
+    total = focalSum(img, radius, ignoreVal)
+    count = focalCount(img, radius, ignoreVal)
+    empty = count == 0
+    count[empty] = 1
+    out = numpy.true_divide(total, count, dtype=numpy.float64)
+    out[empty] = outputNullVal
+    return out
+
+def focalMajority(img, radius, ignoreVal=None, outputNullVal=0):
+    """
+    Returns the most common value in the square window within radius
+    of each pixel. Where two or more values are equally common the
+    smallest is used. Pixels equal to ignoreVal are not used, and
+    outputNullVal is returned where there are no other pixels in the
+    window. Intended for thematic images - each distinct value gets a
+    histogram bin. img may be a single image (2d) or a stack (3d),
+    and the result has the same shape and type.
+
+    The histogram for the window is updated as it moves along each row
+    by adding the column coming in and removing the one going out. The
+    number of values with each count is also kept, so when the majority
+    value loses a pixel the new highest count is known straight away and
+    the search for the value with it stops at the first match.
+    """
+    _checkArgs(img, radius)
+    radius = int(radius)
+    if img.ndim > 2:
+        out = numpy.empty_like(img)
+        for idx in numpy.ndindex(img.shape[:-2]):
+            out[idx] = focalMajority(img[idx], radius, ignoreVal,
+                                outputNullVal)
+        return out
+
+    valid = _validMask(img, ignoreVal)
+    if valid is None:
+        valid = numpy.ones(img.shape, dtype=numpy.bool_)
+
+    # convert the values to one bin per distinct value, keeping them in
+    # order so the smallest bin number is the smallest value. Keeping the
+    # bins compact bounds the cost of looking for a new majority
+    if img.size > 0 and numpy.issubdtype(img.dtype, numpy.integer):
+        minVal = int(img.min())
+        valRange = int(img.max()) - minVal + 1
+    else:
+        valRange = None
+    if valRange is not None and valRange <= max(img.size, MAJORITY_DENSE_MAX):
+        offsets = (img.astype(numpy.int64) - minVal).astype(numpy.intp)
+        present = numpy.bincount(offsets.ravel(), minlength=valRange) > 0
+        binLookup = numpy.cumsum(present) - 1
+        bins = binLookup[offsets]
+        values = (present.nonzero()[0] + minVal).astype(img.dtype)
+    else:
+        values, bins = numpy.unique(img, return_inverse=True)
+        bins = bins.reshape(img.shape).astype(numpy.intp)
+    nBins = values.size
+
+    best = numpy.empty(img.shape, dtype=numpy.intp)
+    _majorityFunc(bins, valid, radius, nBins, best)
+
+    empty = best < 0
+    best[empty] = 0
+    if values.size > 0:
+        out = values[best]
+    else:
+        out = numpy.empty_like(img)
+    out[empty] = outputNullVal
+    return out
+
+@jit
+def _majorityFunc(bins, valid, radius, nBins, best):
+    """
+    Fills best with the bin with the highest count in the window
+    around each pixel (the lowest bin if there is a tie), or -1
+    if there are no valid pixels in the window.
+    """
+    ysize, xsize = bins.shape
+    hist = numpy.zeros(nBins, numpy.int64)
+    # number of bins with each count. The column coming in is added
+    # before the one going out is removed, so allow for an extra column
+    maxCount = (2 * radius + 1) * (2 * radius + 2)
+    countOfCounts = numpy.zeros(maxCount + 1, numpy.int64)
+    for y in range(ysize):
+        y0 = max(0, y - radius)
+        y1 = min(ysize, y + radius + 1)
+        hist[:] = 0
+        countOfCounts[:] = 0
+        bestBin = -1
+        bestCount = 0
+        for x in range(-radius, xsize):
+            # column coming into the window
+            xIn = x + radius
+            if xIn < xsize:
+                for yy in range(y0, y1):
+                    if valid[yy, xIn]:
+                        binNum = bins[yy, xIn]
+                        hist[binNum] += 1
+                        count = hist[binNum]
+                        countOfCounts[count - 1] -= 1
+                        countOfCounts[count] += 1
+                        if count > bestCount or (count == bestCount and
+                                binNum < bestBin):
+                            bestBin = binNum
+                            bestCount = count
+
+            # column going out. Only need to look for the new
+            # best if the current best had a pixel removed
+            xOut = x - radius - 1
+            if xOut >= 0:
+                rescan = False
+                for yy in range(y0, y1):
+                    if valid[yy, xOut]:
+                        binNum = bins[yy, xOut]
+                        count = hist[binNum]
+                        hist[binNum] = count - 1
+                        countOfCounts[count] -= 1
+                        countOfCounts[count - 1] += 1
+                        if binNum == bestBin:
+                            rescan = True
+                if rescan:
+                    # counts only went down, so the highest count is
+                    # now at most bestCount
+                    while bestCount > 0 and countOfCounts[bestCount] == 0:
+                        bestCount -= 1
+                    bestBin = -1
+                    if bestCount > 0:
+                        binNum = 0
+                        while hist[binNum] != bestCount:
+                            binNum += 1
+                        bestBin = binNum
+
+            if x >= 0:
+                best[y, x] = bestBin
+
+def focalBuffer(img, radius, ignoreVal=None):
+    """
+    Returns a uint8 array which is 1 for pixels within radius of a
+    non-zero pixel of img, and 0 elsewhere. This is the same as
+    convolving with mdl.makeBufferKernel(radius) and testing for
+    values greater than zero. Pixels equal to ignoreVal are treated
+    as zero.
+
+    Uses the exact squared Euclidean distance transform, so the cost
+    doesn't depend on the radius.
+    """
+    _checkArgs(img, radius)
+    radius = int(radius)
+    sqDist = _squaredDistance(img, ignoreVal)
+    if sqDist is None:
+        return numpy.zeros(img.shape, dtype=numpy.uint8)
+    # the kernel is the offsets with sqrt(dy**2 + dx**2) <= radius
+    return (sqDist <= radius * radius).astype(numpy.uint8)
+
+def distanceTransform(img, ignoreVal=None):
+    """
+    Returns a float64 array of the Euclidean distance, in pixels, from
+    each pixel to the nearest non-zero pixel of img (so 0 for the
+    non-zero pixels themselves). Pixels equal to ignoreVal are treated
+    as zero. If there are no non-zero pixels the result is all inf.
+    img may be a single image (2d) or a stack (3d) in which case each
+    layer is done separately.
+
+    Note that from RIOS this is only correct for distances up to the
+    overlap.
+    """
+    _checkArgs(img, 0)
+    sqDist = _squaredDistance(img, ignoreVal)
+    if sqDist is None:
+        return numpy.full(img.shape, numpy.inf)
+    dist = numpy.sqrt(sqDist)
+    # layers of a stack with no non-zero pixels
+    dist[sqDist == numpy.iinfo(numpy.int64).max] = numpy.inf
+    return dist
+
+def _squaredDistance(img, ignoreVal):
+    """
+    Returns an int64 array of the squared Euclidean distance from each
+    pixel to the nearest non-zero pixel, or None if there are none.
+    For stacks, layers without any non-zero pixels are all set to the
+    maximum int64 value.
+    """
+    mask = img != 0
+    valid = _validMask(img, ignoreVal)
+    if valid is not None:
+        mask &= valid
+    if not mask.any():
+        return None
+    if img.ndim > 2:
+        sqDist = numpy.empty(img.shape, dtype=numpy.int64)
+        for idx in numpy.ndindex(img.shape[:-2]):
+            if mask[idx].any():
+                _distanceFunc(mask[idx], sqDist[idx])
+            else:
+                sqDist[idx] = numpy.iinfo(numpy.int64).max
+        return sqDist
+
+    sqDist = numpy.empty(img.shape, dtype=numpy.int64)
+    _distanceFunc(mask, sqDist)
+    return sqDist
+
+@jit
+def _distanceFunc(mask, sqDist):
+    """
+    Fills sqDist with the squared Euclidean distance to the nearest
+    True pixel in mask, which must have at least one.
+
+    This is the linear time algorithm from Meijster, Roerdink and
+    Hesselink (2000), "A general algorithm for computing distance
+    transforms in linear time". The first phase finds the distance
+    down each column, the second finds the lower envelope of the
+    parabolas along each row. It is all integer arithmetic so exact.
+    """
+    ysize, xsize = mask.shape
+    infinity = ysize + xsize
+
+    # phase 1 - distance to the nearest True pixel in the same column
+    colDist = numpy.empty((ysize, xsize), numpy.int64)
+    for x in range(xsize):
+        if mask[0, x]:
+            colDist[0, x] = 0
+        else:
+            colDist[0, x] = infinity
+        for y in range(1, ysize):
+            if mask[y, x]:
+                colDist[y, x] = 0
+            else:
+                colDist[y, x] = colDist[y-1, x] + 1
+        for y in range(ysize - 2, -1, -1):
+            if colDist[y+1, x] < colDist[y, x]:
+                colDist[y, x] = colDist[y+1, x] + 1
+
+    # phase 2 - along each row
+    starts = numpy.empty(xsize, numpy.int64)
+    centres = numpy.empty(xsize, numpy.int64)
+    for y in range(ysize):
+        g = colDist[y]
+        q = 0
+        starts[0] = 0
+        centres[0] = 0
+        for u in range(1, xsize):
+            while q >= 0:
+                i = centres[q]
+                t = starts[q]
+                if (t - i) * (t - i) + g[i] * g[i] > (t - u) * (t - u) + g[u] * g[u]:
+                    q -= 1
+                else:
+                    break
+            if q < 0:
+                q = 0
+                centres[0] = u
+            else:
+                # first column where the parabola at u is lower
+                i = centres[q]
+                sep = (u * u - i * i + g[u] * g[u] - g[i] * g[i]) // (2 * (u - i))
+                w = 1 + sep
+                if w < xsize:
+                    q += 1
+                    centres[q] = u
+                    starts[q] = w
+        for u in range(xsize - 1, -1, -1):
+            i = centres[q]
+            sqDist[y, u] = (u - i) * (u - i) + g[i] * g[i]
+            if u == starts[q]:
+                q -= 1
+
+def getOverlap(radius):
+    """
+    Returns the overlap needed in RIOS to apply a focal operation
+    with the given radius across the whole image without edge effects
+    at the block boundaries.
+    """
+    return int(radius)
+
+# the RIOS overlap each operation needs, given the same radius
+focalMax.overlap = getOverlap
+focalMin.overlap = getOverlap
+focalSum.overlap = getOverlap
+focalCount.overlap = getOverlap
+focalMean.overlap = getOverlap
+focalMajority.overlap = getOverlap
+focalBuffer.overlap = getOverlap
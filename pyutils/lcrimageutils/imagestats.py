@@ -0,0 +1,240 @@
+"""
+Whole image statistics, mainly for the globalMean and globalStdDev
+that mdl.stretch() needs. For example::
+
+    from lcrimageutils import imagestats
+    statsList = imagestats.getGlobalStats('input.img', ignoreVals=0)
+
+    def doStretch(info, inputs, outputs, statsList):
+        outputs.outimg = numpy.array([stats.stretch(layer, 2, 0, 255, 0,
+                outputType=numpy.uint8)
+                for stats, layer in zip(statsList, inputs.img)])
+
+"""
+# This file is part of 'gdalutils'
+# Copyright (C) 2014 Sam Gillingham
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+from multiprocessing import Pool
+import numpy
+from osgeo import gdal
+from rios.imagereader import ImageReader
+from . import mdl
+from .zones import splitBlocks
+
+# number of rows of an overview read at a time
+OVERVIEW_STRIP_ROWS = 256
+
+class BandStats(object):
+    """
+    The count, mean and standard deviation of the pixels of one band.
+    Blocks of pixels are added with update() and BandStats from different
+    parts of the image combined with merge(), using the pairwise
+    formula of Chan et al so the variance doesn't suffer from cancellation.
+
+    If sampled is True the pixels are a subsample of the image and
+    meanError and stdDevError are the standard errors of the mean and
+    standard deviation, assuming the pixels are independent. Neighbouring
+    pixels are usually correlated so treat these as a lower bound.
+    If sampled is False they are zero.
+    """
+    def __init__(self, sampled=False):
+        self.sampled = sampled
+        self.count = 0
+        self.mean = 0.0
+        # sum of the squared differences from the mean
+        self.sumSqDiff = 0.0
+
+    def update(self, data):
+        """
+        Adds the given pixel values (any shape)
+        """
+        count = data.size
+        if count == 0:
+            return
+        mean = data.mean(dtype=numpy.float64)
+        diff = numpy.subtract(data, mean, dtype=numpy.float64)
+        sumSqDiff = float(numpy.dot(diff.ravel(), diff.ravel()))
+        self._combine(count, float(mean), sumSqDiff)
+
+    def merge(self, other):
+        """
+        Adds the pixels accumulated in another BandStats
+        """
+        if other.count > 0:
+            self._combine(other.count, other.mean, other.sumSqDiff)
+
+    def _combine(self, count, mean, sumSqDiff):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.sumSqDiff += sumSqDiff + delta * delta * self.count * count / total
+        self.count = total
+
+    @property
+    def stdDev(self):
+        if self.count == 0:
+            return 0.0
+        return numpy.sqrt(self.sumSqDiff / self.count)
+
+    @property
+    def meanError(self):
+        if not self.sampled or self.count == 0:
+            return 0.0
+        return self.stdDev / numpy.sqrt(self.count)
+
+    @property
+    def stdDevError(self):
+        if not self.sampled or self.count < 2:
+            return 0.0
+        return self.stdDev / numpy.sqrt(2 * (self.count - 1))
+
+    def stretch(self, imgLayer, numStdDev, minVal, maxVal, ignoreVal,
+            outputNullVal=0, outputType=None):
+        """
+        Calls mdl.stretch() on imgLayer with these statistics
+        """
+        return mdl.stretch(imgLayer, numStdDev, minVal, maxVal, ignoreVal,
+                    self.mean, self.stdDev, outputNullVal, outputType)
+
+def _validPixels(data, ignoreVal):
+    """
+    Returns the pixels of data that should go into the statistics, as a
+    1d array. For float data non-finite pixels are always dropped, which
+    also covers an ignoreVal of NaN (as a no data value often is) since
+    NaN never compares equal.
+    """
+    if numpy.issubdtype(data.dtype, numpy.floating):
+        valid = numpy.isfinite(data)
+        if ignoreVal is not None and numpy.isfinite(ignoreVal):
+            valid &= (data != ignoreVal)
+        return data[valid]
+    elif ignoreVal is not None:
+        return data[data != ignoreVal]
+    else:
+        return data.ravel()
+
+def _globalStatsBlocks(args):
+    """
+    Accumulates a BandStats for each band from the given blocks of
+    the file. Called by getGlobalStats(), possibly in a worker process.
+    args is a tuple of (filename, bands, ignoreVals, stride, blockIndexes).
+    If blockIndexes is None all the blocks are done.
+    """
+    (filename, bands, ignoreVals, stride, blockIndexes) = args
+    statsList = [BandStats(sampled=stride > 1) for band in bands]
+
+    reader = ImageReader({'img':filename})
+    if blockIndexes is None:
+        blockIndexes = range(len(reader))
+
+    for nblock in blockIndexes:
+        (info, blocks) = reader.readBlock(nblock)
+        # sample every stride'th row and column of the whole image,
+        # not of each block, so blocks don't all start a new stride
+        (xoff, yoff) = info.getPixColRow(0, 0)
+        firstCol = -xoff % stride
+        firstRow = -yoff % stride
+        for stats, band, ignoreVal in zip(statsList, bands, ignoreVals):
+            data = blocks['img'][band-1, firstRow::stride, firstCol::stride]
+            stats.update(_validPixels(data, ignoreVal))
+
+    return statsList
+
+def _overviewStats(filename, bands, ignoreVals, overviewLevel):
+    """
+    Accumulates a BandStats for each band from the given
+    overview level of the file, a strip at a time
+    """
+    ds = gdal.Open(filename)
+    statsList = []
+    for band, ignoreVal in zip(bands, ignoreVals):
+        gdalBand = ds.GetRasterBand(band)
+        nOverviews = gdalBand.GetOverviewCount()
+        if overviewLevel >= nOverviews:
+            raise ValueError("Band %d of %s only has %d overviews" %
+                        (band, filename, nOverviews))
+        overview = gdalBand.GetOverview(overviewLevel)
+        stats = BandStats(sampled=True)
+        for row in range(0, overview.YSize, OVERVIEW_STRIP_ROWS):
+            nrows = min(OVERVIEW_STRIP_ROWS, overview.YSize - row)
+            data = overview.ReadAsArray(0, row, overview.XSize, nrows)
+            stats.update(_validPixels(data, ignoreVal))
+        statsList.append(stats)
+    return statsList
+
+def getGlobalStats(filename, bands=None, ignoreVals=None, numProcs=1,
+                    stride=1, overviewLevel=None):
+    """
+    Calculates the mean and standard deviation of each band of
+    the file in one pass. Returns a list of BandStats objects, one per
+    band, or a single BandStats if bands is a single integer. Each has
+    mean and stdDev attributes to pass to mdl.stretch(), or their
+    stretch() method can be used.
+
+    bands is a list of 1-based band indices, or None for all bands.
+    ignoreVals may be a single value used for all bands, a list with one
+    per band, or None to use the no data value set on each band (if any).
+    Non-finite pixels (NaN and inf) of float bands are always ignored.
+
+    The blocks are shared between numProcs processes.
+
+    For a quicker estimate, stride uses only every stride'th row and
+    column (this saves computation, but the whole file is still read),
+    or overviewLevel (0 being the largest overview) reads an overview
+    instead. The BandStats then give the standard errors of the estimates.
+    Note that overviews built with averaging will have a smaller
+    standard deviation than the image.
+    """
+    origBands = bands # so we know whether to return list or single
+    ds = gdal.Open(filename)
+    if bands is None:
+        bands = range(1, ds.RasterCount + 1)
+    elif isinstance(bands, int):
+        bands = [bands]
+    bands = list(bands)
+
+    if ignoreVals is None:
+        ignoreVals = [ds.GetRasterBand(band).GetNoDataValue() for band in bands]
+    elif numpy.isscalar(ignoreVals):
+        ignoreVals = [ignoreVals] * len(bands)
+    del ds
+
+    if overviewLevel is not None:
+        statsList = _overviewStats(filename, bands, ignoreVals, overviewLevel)
+    elif numProcs > 1:
+        nBlocks = len(ImageReader({'img':filename}))
+        argsList = [(filename, bands, ignoreVals, stride, blockIndexes)
+                        for blockIndexes in splitBlocks(nBlocks, numProcs)]
+        pool = Pool(numProcs)
+        try:
+            partials = pool.map(_globalStatsBlocks, argsList)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        statsList = [BandStats(sampled=stride > 1) for band in bands]
+        for partialList in partials:
+            for stats, partial in zip(statsList, partialList):
+                stats.merge(partial)
+    else:
+        statsList = _globalStatsBlocks((filename, bands, ignoreVals,
+                            stride, None))
+
+    if isinstance(origBands, int):
+        return statsList[0]
+    else:
+        return statsList
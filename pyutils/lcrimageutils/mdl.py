@@ -22,9 +22,11 @@ Imagine Spatial Modeller, but are not native to pymodeller/numpy.
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import os
 import sys
+import json
+import hashlib
 import numpy
-import functools
 try:
     from numba import jit
     HAVE_NUMBA = True
@@ -51,8 +53,33 @@ class NotImageError(MdlFuncError):
 class NonIntTypeError(MdlFuncError):
     pass
 class RangeError(MdlFuncError): pass
+class IndexFileError(MdlFuncError):
+    pass
+
+# ValueIndexes always uses a dense lookup table if the range of values
+# is no more than this, even if it is bigger than the array
+DENSE_LOOKUP_MIN = 2**16
+
+# pixinlist uses a lookup table for integer images if the values
+# span less than this
+PIXINLIST_LOOKUP_MAX = 2**20
+
+# and_list and or_list stop evaluating conditions for chunks
+# of this many rows once the result for them is known
+LOGICAL_CHUNK_ROWS = 64
 
-def stackwhere(mask, trueVal, falseVal):
+# ValueIndexes counts the values in chunks of this many elements, so 
+# it doesn't need any copies the size of the whole array
+VALUE_INDEXES_CHUNK = 2**22
+
+# for files written by ValueIndexes.save()
+INDEX_FILE_MAGIC = b'LCRVALUEINDEXES1\n'
+INDEX_FILE_HEADER_SIZE = 4096
+INDEX_FILE_ALIGN = 64
+# amount of the start and end of the source file hashed for the fingerprint
+FINGERPRINT_BYTES = 2**20
+
+def stackwhere(mask, trueVal, falseVal, out=None, dtype=None):
     """
     Behaves like a numpy "where" function, but specifically for
     use with images and image stacks. Thus, the mask can be a single
@@ -70,6 +97,14 @@ def stackwhere(mask, trueVal, falseVal):
     It seems to work fine for single layer inputs as well, although
     it wasn't really designed for it. They return as a 3-d array, but
     with only one layer. 
+
+    The output is written into out if given, which must be a 3-d array
+    of the right shape, otherwise a new array is created with the given
+    dtype. If dtype is None it is the type numpy.where() would give for
+    the true and false values, so no upcasting is done beyond that.
+    Values are cast to the output type in the same way as astype().
+    The stack is filled by broadcasting the mask, with no temporary
+    arrays per layer.
     
     """
     if numpy.isscalar(mask):
@@ -87,70 +122,255 @@ def stackwhere(mask, trueVal, falseVal):
             nLayersList[i] = 0
         elif val.ndim == 2:
             nLayersList[i] = 1
+            inputList[i] = val[numpy.newaxis, ...]
         elif val.ndim == 3:
             nLayersList[i] = val.shape[0]
         else:
             raise NotImageError("%s is neither a scalar nor a 2-d or 3-d array. Its shape is %s" %
                     (valStr[i], val.shape))
+        if nLayersList[i] > 0 and val.shape[-2:] != mask.shape:
+            raise ShapeMismatchError("%s has shape %s which doesn't match the mask %s" %
+                    (valStr[i], val.shape, mask.shape))
 
     maxLayers = max(nLayersList)
     minLayers = min(nLayersList)
     if maxLayers not in [0, 1] and minLayers not in [0, 1] and maxLayers != minLayers:
         raise ShapeMismatchError("Stacks must have same number of layers: %s != %s"%(maxLayers, minLayers))
     
-    stack = []
-    for i in range(maxLayers):
-        if numpy.isscalar(trueVal) or trueVal.ndim == 2:
-            tVal = trueVal
-        elif trueVal.ndim == 3:
-            tVal = trueVal[i]
-            
-        if numpy.isscalar(falseVal) or falseVal.ndim == 2:
-            fVal = falseVal
-        elif falseVal.ndim == 3:
-            fVal = falseVal[i]
-        
-        img = numpy.where(mask, tVal, fVal)
-        stack.append(img)
-        
-    result = numpy.array(stack)
-    return result
+    shape = (max(maxLayers, 1),) + mask.shape
+    if out is None:
+        if dtype is None:
+            dtype = numpy.result_type(trueVal, falseVal)
+        out = numpy.empty(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise ShapeMismatchError("out has shape %s, needs to be %s" % (out.shape, shape))
+
+    # copyto() only takes a boolean where, but numpy.where() accepts
+    # any truthy mask, such as a uint8 band
+    mask = mask.astype(bool, copy=False)
+    (tVal, fVal) = inputList
+    numpy.copyto(out, fVal, casting='unsafe')
+    numpy.copyto(out, tVal, casting='unsafe', where=mask[numpy.newaxis, ...])
+    return out
 
 
-def and_list(conditionList):
+def and_list(conditionList, out=None, chunkRows=LOGICAL_CHUNK_ROWS):
     """
     Takes a list of condition arrays and does logical_and on the whole
     lot. 
+
+    The result is accumulated into out if given (a boolean array of the
+    shape the conditions broadcast to), otherwise into a new array. It is
+    done in chunks of chunkRows rows (along the first axis), and once a
+    chunk is all False the rest of the conditions are skipped for it.
+    Once every chunk is all False, no more conditions are looked at.
+
+    So that expensive conditions aren't calculated when they aren't
+    needed, conditionList can be a generator, and any of the conditions
+    can be a function. Functions are called with a slice of rows and
+    return the condition for just those rows, e.g.
+    lambda rows: pixinlist(img[rows], valList).
     """
-    return functools.reduce(numpy.logical_and, conditionList)
+    return _logicalList(numpy.logical_and, conditionList, out, chunkRows)
 
-def or_list(conditionList):
+def or_list(conditionList, out=None, chunkRows=LOGICAL_CHUNK_ROWS):
     """
     Takes a list of condition arrays and does logical_or on the whole
     lot. 
+
+    As for and_list(), except that the conditions are skipped for
+    chunks which are all True.
+    """
+    return _logicalList(numpy.logical_or, conditionList, out, chunkRows)
+
+def _logicalList(ufunc, conditionList, out, chunkRows):
     """
-    return functools.reduce(numpy.logical_or, conditionList)
+    Does the work for and_list() and or_list() - ufunc is 
+    numpy.logical_and or numpy.logical_or.
+
+    The conditions broadcast against each other as they would for
+    ufunc on its own. If conditionList is a sequence the output shape
+    comes from all of its (non-function) conditions; for a generator
+    the output is widened if a later condition needs a bigger shape.
+    """
+    isAnd = ufunc is numpy.logical_and
+    haveOut = out is not None
+    if not haveOut and hasattr(conditionList, '__len__'):
+        conditionList = list(conditionList)
+    conditions = iter(conditionList)
+    try:
+        first = next(conditions)
+    except StopIteration:
+        raise MdlFuncError("Need at least one condition")
+    if callable(first) and not haveOut:
+        first = first(slice(None))
+
+    if not haveOut:
+        shapes = [numpy.shape(first)]
+        if isinstance(conditionList, list):
+            shapes.extend([numpy.shape(condition) 
+                    for condition in conditionList[1:] 
+                    if not callable(condition)])
+        out = numpy.empty(_broadcastShape(shapes), dtype=bool)
+
+    def makeChunks(out):
+        if out.ndim == 0:
+            return [Ellipsis]
+        nrows = out.shape[0]
+        return [slice(start, min(start + chunkRows, nrows)) 
+                    for start in range(0, nrows, chunkRows)]
+
+    def getChunk(condition, chunk, out):
+        if callable(condition):
+            return condition(chunk)
+        ndim = numpy.ndim(condition)
+        if ndim < out.ndim or chunk is Ellipsis:
+            # broadcasts along the first axis (or there are no chunks)
+            return condition
+        elif numpy.shape(condition)[0] == 1:
+            return condition
+        return condition[chunk]
+
+    def isDecided(chunkOut):
+        if isAnd:
+            return not chunkOut.any()
+        else:
+            return chunkOut.all()
+
+    def checkShape(condition, out):
+        """
+        Returns out, or a widened copy of it if condition needs one
+        """
+        if callable(condition):
+            return out
+        shape = _broadcastShape([out.shape, numpy.shape(condition)])
+        if shape != out.shape:
+            if haveOut:
+                raise ShapeMismatchError("Condition has shape %s which doesn't fit out %s" % 
+                        (numpy.shape(condition), out.shape))
+            newOut = numpy.empty(shape, dtype=bool)
+            newOut[...] = out
+            out = newOut
+        return out
+
+    out = checkShape(first, out)
+    chunks = makeChunks(out)
+    undecided = []
+    for chunk in chunks:
+        out[chunk] = getChunk(first, chunk, out)
+        if not isDecided(out[chunk]):
+            undecided.append(chunk)
+
+    # don't take the next condition unless it is needed
+    while len(undecided) > 0:
+        try:
+            condition = next(conditions)
+        except StopIteration:
+            break
+        newOut = checkShape(condition, out)
+        if newOut is not out:
+            out = newOut
+            undecided = makeChunks(out)
+        stillUndecided = []
+        for chunk in undecided:
+            chunkOut = out[chunk]
+            ufunc(chunkOut, getChunk(condition, chunk, out), out=chunkOut)
+            if not isDecided(chunkOut):
+                stillUndecided.append(chunk)
+        undecided = stillUndecided
+
+    return out
+
+def _broadcastShape(shapes):
+    """
+    The shape the given shapes broadcast to, raising ShapeMismatchError
+    if they can't
+    """
+    try:
+        return numpy.broadcast_shapes(*shapes)
+    except ValueError:
+        raise ShapeMismatchError("Conditions with shapes %s can't be broadcast together" %
+                (', '.join([str(shape) for shape in shapes]),))
 
 
 def pixinlist(img, valList):
     """
     Returns a mask where pixels are true if the corresponding 
-    pixel values in the input img are in the given valList. 
+    pixel values in the input img are in the given valList, which can
+    be any iterable of values (a list, set, array etc). 
     
     Most useful for lists of specific non-contiguous values. If values are really
     ranges between two values, probably easier to use a logical_and(). 
+
+    Done in one pass over img however long valList is. For 8 and 16 bit
+    images, and other integer images where the values span less than
+    PIXINLIST_LOOKUP_MAX, a lookup table of booleans is indexed with the
+    pixel values. Otherwise each pixel is looked for in the sorted values
+    with a binary search.
     """
+    if not isinstance(valList, numpy.ndarray) and not numpy.isscalar(valList):
+        # sets, dict keys and generators aren't turned into arrays 
+        # by numpy.asarray(), so make a list of them first
+        valList = list(valList)
+    vals = numpy.unique(numpy.asarray(valList).ravel())
+    if img.dtype == numpy.bool_:
+        img = img.view(numpy.uint8)
+
+    if numpy.issubdtype(img.dtype, numpy.integer):
+        # drop any values that can't occur in img
+        info = numpy.iinfo(img.dtype)
+        lower = info.min
+        upper = info.max
+        if vals.dtype == numpy.bool_:
+            vals = vals.astype(numpy.uint8)
+        if numpy.issubdtype(vals.dtype, numpy.integer):
+            # numpy 2 won't compare with a bound that vals can't hold
+            valsInfo = numpy.iinfo(vals.dtype)
+            lower = max(lower, valsInfo.min)
+            upper = min(upper, valsInfo.max)
+        vals = vals[(vals >= lower) & (vals <= upper) & 
+                    (numpy.floor(vals) == vals)].astype(img.dtype)
+        # work with the unsigned equivalent so the lookup 
+        # table can be indexed from zero
+        unsignedType = numpy.dtype('u%d' % img.dtype.itemsize)
+        unsignedVals = vals.view(unsignedType)
+        if img.dtype.itemsize <= 2:
+            lookup = numpy.zeros((2**(8 * img.dtype.itemsize),), dtype=bool)
+            lookup[unsignedVals] = True
+            return lookup[img.view(unsignedType)]
+        elif vals.size > 0 and int(vals[-1]) - int(vals[0]) < PIXINLIST_LOOKUP_MAX:
+            # pixels below the lowest value wrap around to be large, 
+            # then everything outside the range goes to the last entry
+            span = int(vals[-1]) - int(vals[0])
+            lowest = unsignedType.type(unsignedVals[0])
+            lookup = numpy.zeros((span + 2,), dtype=bool)
+            lookup[unsignedVals - lowest] = True
+            offsets = img.view(unsignedType) - lowest
+            numpy.minimum(offsets, span + 1, out=offsets)
+            return lookup[offsets]
+    
     mask = numpy.zeros(img.shape, dtype=bool)
-    for val in valList:
-        mask[img==val] = True
+    if vals.size > 0:
+        idx = numpy.searchsorted(vals, img)
+        numpy.minimum(idx, vals.size - 1, out=idx)
+        numpy.equal(vals[idx], img, out=mask)
     return mask
 
 
-def makestack(inputList):
+def makestack(inputList, out=None, copy=True):
     """
     Makes a single stack of the various images and/or stacks given in 
     the list of inputs. Copes with some being single layer (i.e. 2-D) and some
     being multi-layer (i.e. 3-D). 
+
+    If out is given the layers are copied into it (it must be 3-D with
+    the right shape) and it is returned. 
+
+    If copy is False the stack may share memory with the inputs: a 
+    single input is returned as is (with a new first axis if 2-D), and 
+    layers which are already consecutive in one array are returned as a
+    view of it. This avoids a copy when handing a block to RIOS, but
+    changing the inputs afterwards will change the stack.
     """
     stack = []
     for img in inputList:
@@ -158,93 +378,183 @@ def makestack(inputList):
             stack.append(img[numpy.newaxis, ...])
         elif img.ndim == 3:
             stack.append(img)
+
+    if out is not None:
+        nLayers = sum([layers.shape[0] for layers in stack])
+        shape = (nLayers,) + stack[0].shape[1:]
+        if out.shape != shape:
+            raise ShapeMismatchError("out has shape %s, needs to be %s" % (out.shape, shape))
+        layer = 0
+        for layers in stack:
+            out[layer:layer+layers.shape[0]] = layers
+            layer += layers.shape[0]
+        return out
+
+    if not copy:
+        if len(stack) == 1:
+            return stack[0]
+        view = _stackView(stack)
+        if view is not None:
+            return view
     
     return numpy.concatenate(stack, axis=0)
 
-def clump(input, valid, clumpId=1):
+def _baseArray(arr):
+    """
+    Returns the array that arr is ultimately a view of
+    """
+    while isinstance(arr.base, numpy.ndarray):
+        arr = arr.base
+    return arr
+
+def _stackView(stack):
+    """
+    If the 3-D arrays in stack are consecutive layers of the same
+    array, returns a view of them all as one stack. Otherwise None.
+    """
+    first = stack[0]
+    base = _baseArray(first)
+    layerShape = first.shape[1:]
+    layerStrides = first.strides[1:]
+    # where each layer starts in memory
+    starts = []
+    for layers in stack:
+        if (layers.dtype != first.dtype or layers.shape[1:] != layerShape or
+                layers.strides[1:] != layerStrides or 
+                _baseArray(layers) is not base):
+            return None
+        start = layers.__array_interface__['data'][0]
+        for n in range(layers.shape[0]):
+            starts.append(start + n * layers.strides[0])
+
+    if len(starts) < 2 or starts[1] == starts[0]:
+        return None
+    layerStride = starts[1] - starts[0]
+    for n in range(2, len(starts)):
+        if starts[n] - starts[n-1] != layerStride:
+            return None
+    return numpy.lib.stride_tricks.as_strided(first, 
+                shape=(len(starts),) + layerShape, 
+                strides=(layerStride,) + layerStrides)
+
+def clump(input, valid, clumpId=1, connectivity=4):
     """
     Implementation of clump using Numba
-    Uses the 4 connected algorithm.
+    Uses a two pass union-find algorithm that visits each pixel a
+    constant number of times and needs no scratch memory beyond
+    the output array.
 
     Input should be an integer 2 d array containing the data to be clumped.
     Valid should be a boolean 2 d array containing True where data to be 
         processed
     clumpId is the start clump id to use
+    connectivity should be 4 or 8 and is the number of neighbours
+        of a pixel that are considered part of the same clump
     
+    Clump ids are assigned in the order the first pixel of each clump
+    is found scanning the image row by row.
+
+    The union-find pointers are held in the uint32 output, so input
+    can have no more than 2**32 - 1 pixels. Clump larger images in
+    tiles, as clump_lowmem.py does.
 
     returns a 2d uint32 array containing the clump ids
     and the highest clumpid used + 1
     """
-    (ysize, xsize) = input.shape
-    output = numpy.zeros_like(input, dtype=numpy.uint32)
-    search_list = numpy.empty((xsize*ysize, 2), dtype=numpy.int)
+    if connectivity not in (4, 8):
+        raise MdlFuncError("connectivity must be 4 or 8, not %s" % connectivity)
+    if input.size >= 2**32:
+        raise MdlFuncError("clump can only do up to 2**32 - 1 pixels, not %d" %
+                    input.size)
 
-    clumpId = _clump(input, valid, output, search_list, clumpId)
+    (ysize, xsize) = input.shape
+    output = numpy.zeros((ysize, xsize), dtype=numpy.uint32)
+    
+    # the kernel works on the flattened arrays so it can use the
+    # output to hold the union-find pointers while it goes
+    inputFlat = numpy.ascontiguousarray(input).reshape(-1)
+    validFlat = numpy.ascontiguousarray(valid).reshape(-1)
+    outputFlat = output.reshape(-1)
+
+    clumpId = _clump(inputFlat, validFlat, outputFlat, xsize, 
+                    connectivity == 8, clumpId)
     return output, clumpId
 
 @jit
-def _clump(input, valid, output, search_list, clumpId=1):
+def _clumpFindRoot(output, idx):
+    """
+    For internal use by _clump(). Follows the pointers in output
+    (which are stored as flat index + 1) to the root pixel of idx,
+    pointing each pixel on the path directly at the root.
+    """
+    root = idx
+    while output[root] - 1 != root:
+        root = output[root] - 1
+
+    while output[idx] - 1 != root:
+        nextIdx = output[idx] - 1
+        output[idx] = root + 1
+        idx = nextIdx
+
+    return root
+
+@jit
+def _clumpUnion(input, valid, output, idx, otherIdx):
+    """
+    For internal use by _clump(). Joins the trees of idx and otherIdx
+    if otherIdx is valid and has the same value. The root with the
+    lower index always wins so pointers only ever point backwards.
+    """
+    if valid[otherIdx] and input[otherIdx] == input[idx]:
+        root = _clumpFindRoot(output, idx)
+        otherRoot = _clumpFindRoot(output, otherIdx)
+        if root < otherRoot:
+            output[otherRoot] = root + 1
+        elif otherRoot < root:
+            output[root] = otherRoot + 1
+
+@jit
+def _clump(input, valid, output, xsize, eightConnected, clumpId):
     """
     Implementation of clump using Numba
-    Uses the 4 connected algorithm.
-    returns a 2d uint32 array containing the clump ids
     returns the highest clumpid used + 1
     
-    For internal use by clump()
+    For internal use by clump(). All arrays are flattened.
+    
+    The first pass builds a union-find forest in output, where each
+    valid pixel holds the flat index + 1 of its parent. The
+    neighbours above and to the left are already in the forest so
+    they are the only ones we need to look at. Because pointers only
+    point backwards, the root of each clump is its first pixel.
+    
+    The second pass runs in the same order, so the parent of each pixel
+    already holds its final clump id by the time we get to it.
     """
-    (ysize, xsize) = input.shape
-
-    # lists slow from Numba - use an array since
-    # we know the maximum size
-    searchIdx = 0
-
-    # run through the image
-    for y in range(ysize):
-        for x in range(xsize):
-            # check if we have visited this one before
-            if valid[y, x] and output[y, x] == 0:
-                val = input[y, x]
-                searchIdx = 0
-                search_list[searchIdx, 0] = y
-                search_list[searchIdx, 1] = x
-                searchIdx += 1
-                output[y, x] = clumpId # marked as visited
-
-                while searchIdx > 0:
-                    # search the last one
-                    searchIdx -= 1
-                    sy = search_list[searchIdx, 0]
-                    sx = search_list[searchIdx, 1]
-
-                    # work out the 3x3 window to vist
-                    tlx = sx - 1
-                    if tlx < 0:
-                        tlx = 0
-                    tly = sy - 1
-                    if tly < 0:
-                        tly = 0
-                    brx = sx + 1
-                    if brx > xsize - 1:
-                        brx = xsize - 1
-                    bry = sy + 1
-                    if bry > ysize - 1:
-                        bry = ysize - 1
-
-                    for cx in range(tlx, brx+1):
-                        for cy in range(tly, bry+1):
-                            # do a '4 neighbour search'
-                            # don't have to check we are the middle
-                            # cell since output will be != 0
-                            # since we do that before we add it to search_list
-                            if (cy == sy or cx == sx) and (valid[cy, cx] and 
-                                    output[cy, cx] == 0 and 
-                                    input[cy, cx] == val):
-                                output[cy, cx] = clumpId # mark as visited
-                                # add this one to the ones to search the neighbours
-                                search_list[searchIdx, 0] = cy
-                                search_list[searchIdx, 1] = cx
-                                searchIdx += 1
+    npix = input.shape[0]
+
+    for idx in range(npix):
+        if valid[idx]:
+            # start as our own root
+            output[idx] = idx + 1
+            x = idx % xsize
+            if x > 0:
+                _clumpUnion(input, valid, output, idx, idx - 1)
+            if idx >= xsize:
+                _clumpUnion(input, valid, output, idx, idx - xsize)
+                if eightConnected:
+                    if x > 0:
+                        _clumpUnion(input, valid, output, idx, idx - xsize - 1)
+                    if x < xsize - 1:
+                        _clumpUnion(input, valid, output, idx, idx - xsize + 1)
+
+    for idx in range(npix):
+        if valid[idx]:
+            parent = output[idx] - 1
+            if parent == idx:
+                output[idx] = clumpId
                 clumpId += 1
+            else:
+                output[idx] = output[parent]
 
     return clumpId
 
@@ -281,6 +591,48 @@ def clumpsizeimg(clumps, nullVal=0):
     sizeimg = sizes[clumps]
     return sizeimg
 
+def _uniqueCounts(flat):
+    """
+    Returns the sorted unique values of the 1-d array flat and the 
+    count of each, like numpy.unique(flat, return_counts=True), but 
+    working through flat in chunks so only a chunk is copied at a time. 
+    The results for the chunks are merged when they are as big as the
+    results so far, so each value is merged a limited number of times.
+    """
+    values = flat[:0]
+    counts = numpy.zeros((0,), dtype=numpy.int64)
+    pendingValues = []
+    pendingCounts = []
+    nPending = 0
+    for start in range(0, flat.size, VALUE_INDEXES_CHUNK):
+        (chunkValues, chunkCounts) = numpy.unique(
+                    flat[start:start+VALUE_INDEXES_CHUNK], return_counts=True)
+        pendingValues.append(chunkValues)
+        pendingCounts.append(chunkCounts)
+        nPending += chunkValues.size
+        if nPending >= values.size:
+            (values, counts) = _mergeUniqueCounts([values] + pendingValues, 
+                                    [counts] + pendingCounts)
+            pendingValues = []
+            pendingCounts = []
+            nPending = 0
+    if nPending > 0:
+        (values, counts) = _mergeUniqueCounts([values] + pendingValues, 
+                                    [counts] + pendingCounts)
+    return (values, counts)
+
+def _mergeUniqueCounts(valuesList, countsList):
+    """
+    Merges lists of sorted unique values and their counts into a
+    single array of sorted unique values and their total counts.
+    """
+    allValues = numpy.concatenate(valuesList)
+    allCounts = numpy.concatenate(countsList)
+    (values, inverse) = numpy.unique(allValues, return_inverse=True)
+    counts = numpy.zeros((values.size,), dtype=numpy.int64)
+    numpy.add.at(counts, inverse, allCounts)
+    return (values, counts)
+
 class ValueIndexes(object):
     """
     An object which contains the indexes for every value in a given array.
@@ -301,6 +653,9 @@ class ValueIndexes(object):
         for val in valIndexes.values:
             ndx = valIndexes.getIndexes(val)
             # Do something with all the indexes
+    or, without a lookup for each value
+        for (val, ndx) in valIndexes.iterIndexes():
+            # Do something with all the indexes
     
     
     This is a much faster and more efficient alternative to something like
@@ -320,28 +675,57 @@ class ValueIndexes(object):
     makes it more memory-efficient, so it doesn't store indexes of a whole 
     lot of nulls. 
     
+    The indexes are found with a stable counting sort of the offsets into 
+    the flattened array, so it works for any number of dimensions. Only 
+    one offset is stored per element, rather than one index per 
+    dimension, and they are only turned into coordinates when they are
+    asked for. Pass flat=True to getIndexes(), iterIndexes() and 
+    getIndexesMany() to get the offsets themselves, which can be used
+    directly with a.flat or numpy.take(). 
+    
     A ValueIndexes object has the following attributes:
         values              Array of all values indexed
         counts              Array of counts for each value
         nDims               Number of dimensions of original array
-        indexes             Packed array of indexes
+        shape               Shape of the original array
+        flatIndexes         Packed array of offsets into the flattened array
+        indexes             Packed array of indexes, shape (N, nDims). This
+                            is created from flatIndexes when first used. 
         start               Starting points in indexes array for each value
         end                 End points in indexes for each value
         valLU               Lookup table for each value, to find it in 
                             the values array without explicitly searching. 
+                            None if the values are too sparse.
+        indexDtype          Type used to store the offsets
         nullVals            Array of the null values requested. 
     
-    Limtations:
-        The array index values are handled using unsigned 32bit int values, so 
-        it won't work if the data array is larger than 4Gb. I don't think it would
-        fail very gracefully, either. 
+    The offsets are stored as unsigned 32 bit ints if the array has less 
+    than 2^32 elements, and as unsigned 64 bit ints otherwise. If indexFile
+    is given to the constructor they are stored in a memory-mapped file
+    of that name rather than in memory. 
+    
+    A ValueIndexes object can be saved with save() and opened again, 
+    memory-mapped, with loadValueIndexes(), so the index only needs 
+    building once for a given file. 
+    
+    When the range of values is no bigger than the array, valLU is a 
+    dense lookup table over the range. Otherwise (for instance segment ids
+    spread over a very wide range) valLU is None and values are found 
+    by a binary search of the sorted values array. 
+
+    The values are counted VALUE_INDEXES_CHUNK elements at a time, so
+    apart from the offsets themselves no arrays the size of a are made.
+    The exception is when numba isn't available, as the offsets are then
+    found with numpy.argsort(), which needs several times the memory of a.
     
     """
-    def __init__(self, a, nullVals=[]):
+    def __init__(self, a, nullVals=[], indexFile=None):
         """
         Creates a ValueIndexes object for the given array a. 
         A sequence of null values can be given, and these will not be included
         in the results, so that indexes for these cannot be determined. 
+        If indexFile is given, the index offsets are stored in a 
+        memory-mapped file of that name, which is overwritten. 
         
         """
         if not numpy.issubdtype(a.dtype, numpy.integer):
@@ -352,275 +736,321 @@ class ValueIndexes(object):
         else:
             self.nullVals = nullVals
 
+        flat = a.ravel()
+
         # Get counts of all values in a
         minval = a.min()
         maxval = a.max()
-        (counts, binEdges) = numpy.histogram(a, range=(minval, maxval+1), 
-            bins=(maxval-minval+1))
+        numLookups = int(maxval) - int(minval) + 1
+        denseLookup = numLookups <= max(a.size, DENSE_LOOKUP_MIN)
+        if denseLookup:
+            # python ints so nothing overflows (e.g. maxval+1 for uint8)
+            values = numpy.arange(int(minval), int(maxval) + 1)
+            counts = numpy.zeros((numLookups,), dtype=numpy.int64)
+            for start in range(0, flat.size, VALUE_INDEXES_CHUNK):
+                chunk = flat[start:start+VALUE_INDEXES_CHUNK]
+                counts += numpy.bincount(
+                    (chunk.astype(numpy.int64) - int(minval)).astype(numpy.intp), 
+                    minlength=numLookups)
+        else:
+            # too sparse for a histogram over the whole range
+            (values, counts) = _uniqueCounts(flat)
             
         # Mask counts for any requested null values. 
         maskedCounts = counts.copy()
         for val in self.nullVals:
-            maskedCounts[binEdges[:-1]==val] = 0
-        self.values = binEdges[maskedCounts>0].astype(a.dtype)
+            maskedCounts[values==val] = 0
+        self.values = values[maskedCounts>0].astype(a.dtype)
         self.counts = maskedCounts[maskedCounts>0]
         
         # Allocate space to store all indexes
         totalCounts = self.counts.sum()
         self.nDims = a.ndim
-        self.indexes = numpy.zeros((totalCounts, a.ndim), dtype=numpy.uint32)
+        self.shape = a.shape
         self.end = self.counts.cumsum()
         self.start = self.end - self.counts
-        
+        self._indexes = None
+
+        # offsets need to be able to address every element
+        maxUint32 = 2**32 - 1
+        if a.size <= maxUint32:
+            self.indexDtype = numpy.dtype(numpy.uint32)
+        else:
+            self.indexDtype = numpy.dtype(numpy.uint64)
+
+        if indexFile is not None and totalCounts > 0:
+            self.flatIndexes = numpy.memmap(indexFile, dtype=self.indexDtype, 
+                                    mode='w+', shape=(totalCounts,))
+        else:
+            self.flatIndexes = numpy.zeros((totalCounts,), dtype=self.indexDtype)
+
+        self.valLU = None
         if len(self.values) > 0:
-            # A lookup table to make searching for a value very fast.
-            valrange = numpy.array([self.values.min(), self.values.max()])
-            numLookups = valrange[1] - valrange[0] + 1
-            maxUint32 = 2**32 - 1
-            if numLookups > maxUint32:
-                raise RangeError("Range of different values is too great for uint32")
-            self.valLU = numpy.zeros(numLookups, dtype=numpy.uint32)
-            self.valLU.fill(maxUint32)     # A value to indicate "not found", must match _valndxFunc below
-            self.valLU[self.values - self.values[0]] = range(len(self.values))
-
-            # For use within numba. For each value, the current index 
-            # into the indexes array. A given element is incremented whenever it finds
-            # a new element of that value. 
-            currentIndex = self.start.copy().astype(numpy.uint32)
-
-            # pass the appropriate function in for accessing the 
-            # values in the array. This is to workaround limitation
-            # of numba in that it has to know the dims of the array
-            # it is working with
-            if a.ndim == 1:
-                valndxFunc = _valndxFunc1
-            elif a.ndim == 2:
-                valndxFunc = _valndxFunc2
-            elif a.ndim == 3:
-                valndxFunc = _valndxFunc3
-            elif a.ndim == 4:
-                valndxFunc = _valndxFunc4
-            elif a.ndim == 5:
-                valndxFunc = _valndxFunc5
-            elif a.ndim == 6:
-                valndxFunc = _valndxFunc6
+            # int64 so offsets from the minimum don't wrap for small types
+            valrange = numpy.array([self.values.min(), self.values.max()], 
+                            dtype=numpy.int64)
+            if denseLookup and len(self.values) < maxUint32:
+                # A lookup table to make searching for a value very fast.
+                self.valLU = numpy.zeros(numLookups, dtype=numpy.uint32)
+                self.valLU.fill(maxUint32)     # A value to indicate "not found", must match _valndxFunc below
+                self.valLU[self.values.astype(numpy.int64) - int(self.values[0])] = range(len(self.values))
+
+            # the offsets of each element in the flattened array
+            # grouped by value in increasing order
+            if HAVE_NUMBA:
+                # For use within numba. For each value, the current index 
+                # into the indexes array. A given element is incremented whenever it finds
+                # a new element of that value. 
+                currentIndex = self.start.astype(self.indexDtype)
+                if self.valLU is not None:
+                    _valndxFunc(flat, self.flatIndexes, valrange[0], valrange[1], 
+                            self.valLU, currentIndex)
+                else:
+                    _valndxSortedFunc(flat, self.flatIndexes, self.values,
+                            currentIndex)
             else:
-                raise ShapeMismatchError('Array can only have 6 or viewer dimensions')
-
-            shape = numpy.array(a.shape, dtype=numpy.int)
-            # our array that contains the current index in each of the dims
-            curridx = numpy.zeros_like(shape)
-            valndxFunc(a, shape, a.ndim, self.indexes, valrange[0], valrange[1], 
-                        self.valLU, currentIndex, curridx)
+                # a stable sort keeps the offsets for each value in order
+                # which is what the counting sort above does
+                if len(self.nullVals) > 0:
+                    offsets = (~numpy.isin(flat, self.nullVals)).nonzero()[0]
+                    order = numpy.argsort(flat[offsets], kind='stable')
+                    self.flatIndexes[:] = offsets[order]
+                else:
+                    self.flatIndexes[:] = numpy.argsort(flat, kind='stable')
+
+    @property
+    def indexes(self):
+        """
+        Packed array of indexes, shape (N, nDims), created from 
+        flatIndexes the first time it is used.
+        """
+        if self._indexes is None:
+            self._indexes = numpy.zeros((self.flatIndexes.size, self.nDims), 
+                                dtype=self.indexDtype)
+            coords = numpy.unravel_index(self.flatIndexes, self.shape)
+            for i in range(self.nDims):
+                self._indexes[:, i] = coords[i]
+        return self._indexes
+
+    def findValues(self, vals):
+        """
+        Returns an array with the position of each of vals in the values 
+        array (and so in counts, start and end), or -1 where a value 
+        wasn't found. Uses valLU if there is one, otherwise a binary 
+        search of values. 
+        """
+        vals = numpy.asarray(vals)
+        valNdx = numpy.empty(vals.shape, dtype=numpy.int64)
+        valNdx.fill(-1)
+        if len(self.values) == 0:
+            return valNdx
+
+        if self.valLU is not None:
+            lookup = vals.astype(numpy.int64) - int(self.values[0])
+            inRange = (lookup >= 0) & (lookup < self.valLU.size)
+            valNdx[inRange] = self.valLU[lookup[inRange]]
+            valNdx[valNdx == 2**32 - 1] = -1
+        else:
+            pos = numpy.searchsorted(self.values, vals)
+            pos = pos.clip(0, len(self.values) - 1)
+            found = self.values[pos] == vals
+            valNdx[found] = pos[found]
+        return valNdx
 
-    def getIndexes(self, val):
+    def getIndexes(self, val, flat=False):
         """
         Return a set of indexes into the original array, for which the
         value in the array is equal to val. 
         
+        If flat is True, returns the offsets into the flattened array
+        instead, which can be used with a.flat or numpy.take(). This 
+        is a view into flatIndexes so nothing is allocated.
+        
         """
         # Find where this value is listed. 
-        valNdx = (self.values == val).nonzero()[0]
+        valNdx = self.findValues(val)
         
         # If this value is not actually in those listed, then we 
         # must return empty indexes
-        if len(valNdx) == 0:
+        if valNdx < 0:
             start = 0
             end = 0
         else:
             # The index into counts, etc. for this value. 
-            valNdx = valNdx[0]
             start = self.start[valNdx]
             end = self.end[valNdx]
             
-        # Create a tuple of index arrays, one for each index of the original array. 
-        ndx = ()
-        for i in range(self.nDims):
-            ndx += (self.indexes[start:end, i], )
-        return ndx
-
-@jit
-def _valndxFunc1(a, shape, ndim, indexes, minVal, maxVal, valLU, currentIndex, curridx):
-    """
-    To be called by ValueIndexes. An implementation using Numba of Neil's
-    C code. This has the advantage of being able to handle any integer
-    type passed.
-    """
-    done = False
-    lastidx = ndim - 1
-    maxuint32 = 4294967295 # 2^32 - 1
-
-    while not done:
-        # use the specially chosen function for indexing the array
-        arrVal = a[curridx[0]]
-        
-        found = False
-        j = 0
-        if arrVal >= minVal and arrVal <= maxVal:
-            j = valLU[arrVal - minVal]
-            found = j < maxuint32
-
-        if found:
-            m = currentIndex[j]
-            for i in range(ndim):
-                indexes[m, i] = curridx[i]
-            currentIndex[j] = m + 1        
-    
-        # code that updates curridx - incs the next dim
-        # if we have done all the elements in the current 
-        # dim
-        idx = lastidx
-        while idx >= 0:
-            curridx[idx] = curridx[idx] + 1
-            if curridx[idx] >= shape[idx]:
-                curridx[idx] = 0
-                idx -= 1
-            else:
-                break
+        if flat:
+            return self.flatIndexes[start:end]
 
-        # if we are done we have run out of dims
-        done = idx < 0
+        # Create a tuple of index arrays, one for each index of the original array. 
+        return numpy.unravel_index(self.flatIndexes[start:end], self.shape)
 
-@jit
-def _valndxFunc2(a, shape, ndim, indexes, minVal, maxVal, valLU, currentIndex, curridx):
-    """
-    To be called by ValueIndexes. An implementation using Numba of Neil's
-    C code. This has the advantage of being able to handle any integer
-    type passed.
-    """
-    done = False
-    lastidx = ndim - 1
-    maxuint32 = 4294967295 # 2^32 - 1
+    def iterIndexes(self, flat=False):
+        """
+        Iterate over the (value, indexes) pairs for every value, where 
+        indexes is as returned by getIndexes(). The index arrays are 
+        views into the indexes attribute so nothing is allocated 
+        for each value.
+        If flat is True, the indexes are offsets into the flattened array, 
+        as views into flatIndexes. This avoids creating the indexes 
+        attribute, which needs nDims times as much memory.
+        """
+        if flat:
+            for valNdx in range(len(self.values)):
+                yield (self.values[valNdx], 
+                    self.flatIndexes[self.start[valNdx]:self.end[valNdx]])
+            return
+
+        columns = [self.indexes[:, i] for i in range(self.nDims)]
+        for valNdx in range(len(self.values)):
+            start = self.start[valNdx]
+            end = self.end[valNdx]
+            yield self.values[valNdx], tuple([column[start:end] 
+                                                for column in columns])
 
-    while not done:
-        # use the specially chosen function for indexing the array
-        arrVal = a[curridx[0], curridx[1]]
-        
-        found = False
-        j = 0
-        if arrVal >= minVal and arrVal <= maxVal:
-            j = valLU[arrVal - minVal]
-            found = j < maxuint32
+    def getIndexesMany(self, vals, flat=False):
+        """
+        Return the indexes for all of the values in vals in one go. 
+        Returns a tuple of (indexes, offsets). indexes is a tuple of index 
+        arrays, as for getIndexes(), with the indexes for each value in
+        turn concatenated. The indexes for vals[i] are from offsets[i] 
+        to offsets[i+1]. Values not found have no indexes.
+        If flat is True, indexes is a single array of offsets into
+        the flattened array.
+        """
+        valNdx = self.findValues(numpy.asarray(vals).ravel())
+        found = valNdx >= 0
+        # index with 0 where not found, so -1 is never used (values may
+        # even be empty), then mask those out
+        safeNdx = numpy.where(found, valNdx, 0)
+        if len(self.values) == 0:
+            starts = numpy.zeros(valNdx.shape, dtype=numpy.int64)
+            lengths = numpy.zeros(valNdx.shape, dtype=numpy.int64)
+        else:
+            starts = numpy.where(found, self.start[safeNdx], 0)
+            lengths = numpy.where(found, self.counts[safeNdx], 0)
 
-        if found:
-            m = currentIndex[j]
-            for i in range(ndim):
-                indexes[m, i] = curridx[i]
-            currentIndex[j] = m + 1        
-    
-        # code that updates curridx - incs the next dim
-        # if we have done all the elements in the current 
-        # dim
-        idx = lastidx
-        while idx >= 0:
-            curridx[idx] = curridx[idx] + 1
-            if curridx[idx] >= shape[idx]:
-                curridx[idx] = 0
-                idx -= 1
-            else:
-                break
+        offsets = numpy.zeros((len(valNdx) + 1,), dtype=numpy.int64)
+        offsets[1:] = lengths.cumsum()
 
-        # if we are done we have run out of dims
-        done = idx < 0
+        # position in flatIndexes of each of the results
+        positions = (numpy.repeat(starts - offsets[:-1], lengths) + 
+                        numpy.arange(offsets[-1]))
+        ndx = self.flatIndexes[positions]
+        if not flat:
+            ndx = numpy.unravel_index(ndx, self.shape)
+        return ndx, offsets
 
-@jit
-def _valndxFunc3(a, shape, ndim, indexes, minVal, maxVal, valLU, currentIndex, curridx):
+    def save(self, filename, sourceFile=None):
+        """
+        Saves this object to filename in a compact format that 
+        loadValueIndexes() can open memory-mapped, without reading 
+        or rebuilding anything. If sourceFile is given (the file the
+        array was read from) a fingerprint of it is saved so 
+        loadValueIndexes() can check the index is still up to date. 
+        """
+        arrays = [('values', self.values), ('counts', self.counts), 
+                    ('start', self.start), ('end', self.end), 
+                    ('flatIndexes', self.flatIndexes)]
+        if self.valLU is not None:
+            arrays.append(('valLU', self.valLU))
+
+        fingerprint = None
+        if sourceFile is not None:
+            fingerprint = fileFingerprint(sourceFile)
+
+        # work out where each array goes, aligned so they can be mapped
+        header = {'shape':[int(n) for n in self.shape], 
+                'nullVals':[int(val) for val in self.nullVals],
+                'indexDtype':self.indexDtype.str, 
+                'fingerprint':fingerprint, 'arrays':{}}
+        headerSize = INDEX_FILE_HEADER_SIZE
+        offset = headerSize
+        for (name, arr) in arrays:
+            header['arrays'][name] = (offset, arr.dtype.str, int(arr.size))
+            offset += arr.nbytes
+            offset += -offset % INDEX_FILE_ALIGN
+
+        headerBytes = json.dumps(header).encode()
+        if len(INDEX_FILE_MAGIC) + len(headerBytes) + 1 > headerSize:
+            raise IndexFileError("Too many null values to save")
+
+        with open(filename, 'wb') as f:
+            f.write(INDEX_FILE_MAGIC)
+            f.write(headerBytes + b'\n')
+            for (name, arr) in arrays:
+                f.seek(header['arrays'][name][0])
+                numpy.ascontiguousarray(arr).tofile(f)
+            f.truncate(offset)
+
+def loadValueIndexes(filename, sourceFile=None):
     """
-    To be called by ValueIndexes. An implementation using Numba of Neil's
-    C code. This has the advantage of being able to handle any integer
-    type passed.
+    Opens a ValueIndexes object saved with ValueIndexes.save(). The
+    arrays are memory-mapped read-only, so this is very quick however big
+    the index is. If sourceFile is given, it is checked against the 
+    fingerprint saved with the index and IndexFileError is raised
+    if it has changed (or no fingerprint was saved). 
     """
-    done = False
-    lastidx = ndim - 1
-    maxuint32 = 4294967295 # 2^32 - 1
-
-    while not done:
-        # use the specially chosen function for indexing the array
-        arrVal = a[curridx[0], curridx[1], curridx[2]]
-        
-        found = False
-        j = 0
-        if arrVal >= minVal and arrVal <= maxVal:
-            j = valLU[arrVal - minVal]
-            found = j < maxuint32
-
-        if found:
-            m = currentIndex[j]
-            for i in range(ndim):
-                indexes[m, i] = curridx[i]
-            currentIndex[j] = m + 1        
-    
-        # code that updates curridx - incs the next dim
-        # if we have done all the elements in the current 
-        # dim
-        idx = lastidx
-        while idx >= 0:
-            curridx[idx] = curridx[idx] + 1
-            if curridx[idx] >= shape[idx]:
-                curridx[idx] = 0
-                idx -= 1
-            else:
-                break
+    with open(filename, 'rb') as f:
+        magic = f.read(len(INDEX_FILE_MAGIC))
+        if magic != INDEX_FILE_MAGIC:
+            raise IndexFileError("%s is not a ValueIndexes file" % filename)
+        header = json.loads(f.readline().decode())
+
+    if sourceFile is not None:
+        if header['fingerprint'] != fileFingerprint(sourceFile):
+            raise IndexFileError("%s does not match the file %s was made from" % 
+                                    (sourceFile, filename))
+
+    valIndexes = ValueIndexes.__new__(ValueIndexes)
+    valIndexes.shape = tuple(header['shape'])
+    valIndexes.nDims = len(valIndexes.shape)
+    valIndexes.nullVals = header['nullVals']
+    valIndexes.indexDtype = numpy.dtype(header['indexDtype'])
+    valIndexes.valLU = None
+    valIndexes._indexes = None
+
+    for name in header['arrays'].keys():
+        (offset, dtype, size) = header['arrays'][name]
+        if size == 0:
+            arr = numpy.zeros((0,), dtype=dtype)
+        else:
+            arr = numpy.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                                shape=(size,))
+        setattr(valIndexes, name, arr)
 
-        # if we are done we have run out of dims
-        done = idx < 0
+    return valIndexes
 
-@jit
-def _valndxFunc4(a, shape, ndim, indexes, minVal, maxVal, valLU, currentIndex, curridx):
+def fileFingerprint(filename):
     """
-    To be called by ValueIndexes. An implementation using Numba of Neil's
-    C code. This has the advantage of being able to handle any integer
-    type passed.
+    Returns a fingerprint of a file, made from its size, modification
+    time and a hash of the start and end of the file, so that saved 
+    indexes can be checked without reading the whole file. 
     """
-    done = False
-    lastidx = ndim - 1
-    maxuint32 = 4294967295 # 2^32 - 1
-
-    while not done:
-        # use the specially chosen function for indexing the array
-        arrVal = a[curridx[0], curridx[1], curridx[2], curridx[3]]
-        
-        found = False
-        j = 0
-        if arrVal >= minVal and arrVal <= maxVal:
-            j = valLU[arrVal - minVal]
-            found = j < maxuint32
-
-        if found:
-            m = currentIndex[j]
-            for i in range(ndim):
-                indexes[m, i] = curridx[i]
-            currentIndex[j] = m + 1        
-    
-        # code that updates curridx - incs the next dim
-        # if we have done all the elements in the current 
-        # dim
-        idx = lastidx
-        while idx >= 0:
-            curridx[idx] = curridx[idx] + 1
-            if curridx[idx] >= shape[idx]:
-                curridx[idx] = 0
-                idx -= 1
-            else:
-                break
-
-        # if we are done we have run out of dims
-        done = idx < 0
+    fileStat = os.stat(filename)
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        md5.update(f.read(FINGERPRINT_BYTES))
+        if fileStat.st_size > FINGERPRINT_BYTES:
+            f.seek(max(fileStat.st_size - FINGERPRINT_BYTES, FINGERPRINT_BYTES))
+            md5.update(f.read(FINGERPRINT_BYTES))
+    return {'size':fileStat.st_size, 'mtime':fileStat.st_mtime, 
+                'md5':md5.hexdigest()}
 
 @jit
-def _valndxFunc5(a, shape, ndim, indexes, minVal, maxVal, valLU, currentIndex, curridx):
+def _valndxFunc(flat, indexes, minVal, maxVal, valLU, currentIndex):
     """
     To be called by ValueIndexes. An implementation using Numba of Neil's
     C code. This has the advantage of being able to handle any integer
-    type passed.
+    type passed. Works on the flattened array so it doesn't matter how
+    many dimensions the original array has. Stores the offset of each
+    element in indexes, grouped by value. 
     """
-    done = False
-    lastidx = ndim - 1
     maxuint32 = 4294967295 # 2^32 - 1
 
-    while not done:
-        # use the specially chosen function for indexing the array
-        arrVal = a[curridx[0], curridx[1], curridx[2], curridx[3], curridx[4]]
+    for idx in range(flat.shape[0]):
+        arrVal = flat[idx]
         
         found = False
         j = 0
@@ -630,70 +1060,37 @@ def _valndxFunc5(a, shape, ndim, indexes, minVal, maxVal, valLU, currentIndex, c
 
         if found:
             m = currentIndex[j]
-            for i in range(ndim):
-                indexes[m, i] = curridx[i]
+            indexes[m] = idx
             currentIndex[j] = m + 1        
-    
-        # code that updates curridx - incs the next dim
-        # if we have done all the elements in the current 
-        # dim
-        idx = lastidx
-        while idx >= 0:
-            curridx[idx] = curridx[idx] + 1
-            if curridx[idx] >= shape[idx]:
-                curridx[idx] = 0
-                idx -= 1
-            else:
-                break
-
-        # if we are done we have run out of dims
-        done = idx < 0
 
 @jit
-def _valndxFunc6(a, shape, ndim, indexes, minVal, maxVal, valLU, currentIndex, curridx):
+def _valndxSortedFunc(flat, indexes, values, currentIndex):
     """
-    To be called by ValueIndexes. An implementation using Numba of Neil's
-    C code. This has the advantage of being able to handle any integer
-    type passed.
+    To be called by ValueIndexes when the values are too sparse for a
+    lookup table. Same as _valndxFunc but finds each value with a 
+    binary search of the sorted values array. 
     """
-    done = False
-    lastidx = ndim - 1
-    maxuint32 = 4294967295 # 2^32 - 1
+    nValues = values.shape[0]
 
-    while not done:
-        # use the specially chosen function for indexing the array
-        arrVal = a[curridx[0], curridx[1], curridx[2], curridx[3], curridx[4], curridx[5]]
-        
-        found = False
-        j = 0
-        if arrVal >= minVal and arrVal <= maxVal:
-            j = valLU[arrVal - minVal]
-            found = j < maxuint32
+    for idx in range(flat.shape[0]):
+        arrVal = flat[idx]
 
-        if found:
-            m = currentIndex[j]
-            for i in range(ndim):
-                indexes[m, i] = curridx[i]
-            currentIndex[j] = m + 1        
-    
-        # code that updates curridx - incs the next dim
-        # if we have done all the elements in the current 
-        # dim
-        idx = lastidx
-        while idx >= 0:
-            curridx[idx] = curridx[idx] + 1
-            if curridx[idx] >= shape[idx]:
-                curridx[idx] = 0
-                idx -= 1
+        lower = 0
+        upper = nValues
+        while lower < upper:
+            middle = (lower + upper) // 2
+            if values[middle] < arrVal:
+                lower = middle + 1
             else:
-                break
+                upper = middle
 
-        # if we are done we have run out of dims
-        done = idx < 0
+        if lower < nValues and values[lower] == arrVal:
+            m = currentIndex[lower]
+            indexes[m] = idx
+            currentIndex[lower] = m + 1
 
 
-
-def prewitt(img):
+def prewitt(img, out=None, dtype=numpy.float64):
     """
     Implements a prewitt edge detection filter which behaves the same as the
     one in Imagine Spatial Modeller. 
@@ -708,45 +1105,126 @@ def prewitt(img):
     the settings should have a window overlap of 1. The returned array is of type
     float, and care should be taken if truncating to an integer type. The magnitude 
     of the edge array scales with the magnitude of the input pixel values. 
+
+    The result is written into out if it is given (it must have the same
+    shape as img and a floating point type), otherwise a new array of the 
+    given dtype is created. out can be img itself if img is floating point. Passing dtype=numpy.float32 halves the memory
+    used and is faster, at the cost of precision. With the default float64
+    the result is identical to the original row by row implementation.
     
     """
-    kernel1 = numpy.array([1.0, 0.0, -1.0])
-    kernel2 = numpy.array([1.0, 1.0, 1.0])
-    Gx1 = convRows(img, kernel1)
-    Gx = convCols(Gx1, kernel2)
-    Gy1 = convCols(img, kernel1)
-    Gy = convRows(Gy1, kernel2)
+    kernel1 = numpy.array([1.0, 0.0, -1.0], dtype=dtype)
+    kernel2 = numpy.array([1.0, 1.0, 1.0], dtype=dtype)
+    if out is None:
+        out = numpy.empty(img.shape, dtype=dtype)
+    work = out.dtype
+
+    # img is finished with before anything is written to out, so out
+    # can be img itself. Gx ends up in out and Gy in tmp1, so only two 
+    # temporaries are needed
+    tmp1 = convRows(img, kernel1, dtype=work)
+    tmp2 = convCols(img, kernel1, dtype=work)
+    Gx = convCols(tmp1, kernel2, out=out)
+    Gy = convRows(tmp2, kernel2, out=tmp1)
+    del tmp2
     
-    G = numpy.sqrt(Gx*Gx + Gy*Gy)
+    numpy.multiply(Gx, Gx, out=Gx)
+    numpy.multiply(Gy, Gy, out=Gy)
+    numpy.add(Gx, Gy, out=Gx)
+    numpy.sqrt(Gx, out=Gx)
     
-    return G
+    return out
 
-def convRows(a, b):
+def _correlate(a, b, axis, out, dtype):
     """
-    Utility function to convolve b along the rows of a
+    Correlate the 1d kernel b along the given axis of the 2d array a,
+    in the same way as numpy.correlate() in 'valid' mode, but for 
+    all rows (or columns) at once using shifted slices. The half kernel 
+    width at each edge is set to zero. 
+
+    The terms are accumulated in kernel order, as numpy.correlate does, 
+    so the results are the same to the bit.
     """
-    out = numpy.zeros(a.shape)
-    for i in range(a.shape[0]):
-        out[i,1:-1] = numpy.correlate(a[i,:], b)
+    b = numpy.asarray(b, dtype=dtype)
+    if out is None:
+        out = numpy.empty(a.shape, dtype=dtype)
+    elif numpy.shares_memory(a, out):
+        # the shifted slices of a would be read after out is written
+        a = a.copy()
+    n = a.shape[axis]
+    size = b.shape[0]
+    half = size // 2
+    width = n - size + 1
+    if width < 1:
+        out.fill(0)
+        return out
+
+    def shifted(arr, start, length):
+        if axis == 0:
+            return arr[start:start+length]
+        else:
+            return arr[:, start:start+length]
+
+    # zero the edges that the kernel doesn't reach
+    shifted(out, 0, half).fill(0)
+    shifted(out, half + width, n - half - width).fill(0)
+
+    # pass dtype explicitly so small integer inputs are not computed
+    # at a lower precision by numpy's scalar casting rules
+    work = out.dtype
+    centre = shifted(out, half, width)
+    numpy.multiply(shifted(a, 0, width), b[0], out=centre, dtype=work)
+    tmp = None
+    for k in range(1, size):
+        aSlice = shifted(a, k, width)
+        coeff = b[k]
+        # multiplying by +/-1 is exact, so those can skip the multiply
+        if coeff == 1:
+            numpy.add(centre, aSlice, out=centre, dtype=work)
+        elif coeff == -1:
+            numpy.subtract(centre, aSlice, out=centre, dtype=work)
+        else:
+            if tmp is None:
+                tmp = numpy.empty(centre.shape, dtype=work)
+            numpy.multiply(aSlice, coeff, out=tmp, dtype=work)
+            numpy.add(centre, tmp, out=centre)
     return out
 
-def convCols(a, b):
+def convRows(a, b, out=None, dtype=numpy.float64):
     """
-    Utility function to convolve b along the cols of a
+    Utility function to convolve b along the rows of a.
+    The result is written to out if given, otherwise a new array of dtype
+    is created. If out is a (or overlaps it) a is copied first.
     """
-    out = numpy.zeros(a.shape)
-    for j in range(a.shape[1]):
-        out[1:-1,j] = numpy.correlate(a[:,j], b)
-    return out
+    return _correlate(a, b, 1, out, dtype if out is None else out.dtype)
+
+def convCols(a, b, out=None, dtype=numpy.float64):
+    """
+    Utility function to convolve b along the cols of a.
+    The result is written to out if given, otherwise a new array of dtype
+    is created. If out is a (or overlaps it) a is copied first.
+    """
+    return _correlate(a, b, 0, out, dtype if out is None else out.dtype)
 
 def stretch(imgLayer, numStdDev, minVal, maxVal, ignoreVal, 
-        globalMean, globalStdDev, outputNullVal=0):
+        globalMean, globalStdDev, outputNullVal=0, outputType=None):
     """
     Implements the Imagine Modeller STRETCH function. Takes
     a single band and applies a histogram stretch to it, returning
     the stretched image. The returned image is always a 2-d array. 
+
+    If outputType is given (e.g. numpy.uint8) a faster method is used
+    which returns an array of that type directly, with the same values 
+    as stretch(...).astype(outputType) apart from floating point rounding.
+    The stretch is worked out as a scale and offset, applied in place 
+    in one output array. For 8 and 16 bit images the stretched value of
+    every possible pixel value is worked out once and then looked up.
     
     """
+    if outputType is not None:
+        return _fastStretch(imgLayer, numStdDev, minVal, maxVal, ignoreVal,
+                    globalMean, globalStdDev, outputNullVal, 
+                    numpy.dtype(outputType))
 
     stretched = (minVal + 
         ((imgLayer - globalMean + globalStdDev * numStdDev) * (maxVal - minVal))/(globalStdDev * 2 *numStdDev))
@@ -755,10 +1233,51 @@ def stretch(imgLayer, numStdDev, minVal, maxVal, ignoreVal,
     stretched = numpy.where(imgLayer == ignoreVal, outputNullVal, stretched)
     return stretched
 
+def _fastStretch(imgLayer, numStdDev, minVal, maxVal, ignoreVal, 
+        globalMean, globalStdDev, outputNullVal, outputType):
+    """
+    stretch() with an outputType
+    """
+    # minVal + (img - mean + stddev * n) * (max - min) / (stddev * 2 * n)
+    scale = float(maxVal - minVal) / (globalStdDev * 2 * numStdDev)
+    offset = minVal + (globalStdDev * numStdDev - globalMean) * scale
+
+    inputType = imgLayer.dtype
+    if inputType == numpy.bool_ or (numpy.issubdtype(inputType, numpy.integer)
+            and inputType.itemsize <= 2):
+        # lookup table for every possible value. Index with the
+        # unsigned equivalent so signed types work too
+        unsignedType = numpy.dtype('u%d' % inputType.itemsize)
+        allVals = numpy.arange(2**(8 * inputType.itemsize), 
+                        dtype=unsignedType).view(inputType)
+        lookup = allVals * scale
+        lookup += offset
+        lookup.clip(minVal, maxVal, out=lookup)
+        lookup = lookup.astype(outputType)
+        if ignoreVal is not None:
+            lookup[allVals == ignoreVal] = outputNullVal
+        return lookup[imgLayer.view(unsignedType)]
+
+    if numpy.issubdtype(outputType, numpy.floating):
+        stretched = numpy.empty(imgLayer.shape, dtype=outputType)
+    else:
+        stretched = numpy.empty(imgLayer.shape, dtype=numpy.float64)
+    numpy.multiply(imgLayer, scale, out=stretched, casting='unsafe')
+    stretched += offset
+    stretched.clip(minVal, maxVal, out=stretched)
+    if stretched.dtype != outputType:
+        stretched = stretched.astype(outputType)
+    if ignoreVal is not None:
+        numpy.copyto(stretched, outputNullVal, casting='unsafe', 
+                    where=(imgLayer == ignoreVal))
+    return stretched
+
 def makeBufferKernel(buffsize):
     """
     Make a 2-d array for buffering. It represents a circle of 
     radius buffsize pixels, with 1 inside the circle, and zero outside.
+    For buffering large radii, focal.focalBuffer() gives the same
+    result much faster than convolving with this kernel.
     """
     bufferkernel = None
     if buffsize > 0:
@@ -0,0 +1,466 @@
+"""
+Lazy versions of the mdl functions, for building up a model as an
+expression which is then evaluated in one go. For example::
+
+    from lcrimageutils import mdlexpr
+    landcover = mdlexpr.asExpr(block.landcover)
+    ndvi = mdlexpr.asExpr(block.ndvi)
+    mask = mdlexpr.and_list([ndvi > 0.3, ndvi < 0.9,
+                mdlexpr.pixinlist(landcover, [2, 5, 11])])
+    block.outimg = mdlexpr.stackwhere(mask, block.img, 0).evaluate()
+
+Nothing is calculated until evaluate() is called. The expression is
+then worked out a few rows at a time (CHUNK_BYTES of input at a time,
+so it fits in the CPU cache), writing into the output, so the temporary
+arrays are only the size of a chunk rather than the whole block. The
+&, | and ~ operators are logical (like numpy.logical_and etc) rather
+than bitwise.
+
+If numexpr is installed, evaluate(useNumexpr=True) passes the
+comparisons and logical operations (including and_list and or_list)
+to it as one expression per chunk, so there are no temporaries for
+these at all. This is off by default as numpy's own comparisons are
+faster on a single core - it is only worth trying with several cores.
+
+All the arrays must be images (2-d) or stacks (3-d) with the same
+number of rows and columns. The results are the same as calling
+the mdl functions on the whole arrays.
+
+"""
+# This file is part of 'gdalutils'
+# Copyright (C) 2014 Sam Gillingham
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import numpy
+from . import mdl
+try:
+    import numexpr
+    HAVE_NUMEXPR = True
+except ImportError:
+    HAVE_NUMEXPR = False
+
+# roughly how many bytes of the inputs are processed at a time
+CHUNK_BYTES = 2**18
+
+# numexpr operators for the comparison ufuncs
+COMPARE_OPS = {numpy.less:'<', numpy.less_equal:'<=', numpy.greater:'>',
+    numpy.greater_equal:'>=', numpy.equal:'==', numpy.not_equal:'!='}
+
+class Expr(object):
+    """
+    Base class for the nodes of an expression. Use asExpr() to
+    wrap an array and then the operators and the functions in this
+    module to build up the expression.
+    """
+    def __init__(self, args):
+        self.args = [asExpr(arg) for arg in args]
+
+    def evaluate(self, out=None, chunkBytes=CHUNK_BYTES, useNumexpr=False):
+        """
+        Calculates the expression, a few rows at a time. The result
+        is written into out if given, otherwise a new array is
+        returned. If useNumexpr is True and numexpr is installed
+        it is used for the comparisons and logical operations.
+        """
+        return evaluate(self, out, chunkBytes, useNumexpr)
+
+    def calc(self, values):
+        """
+        Calculates this node for one chunk, given the values of
+        its args for that chunk
+        """
+        raise NotImplementedError()
+
+    def __and__(self, other):
+        return _Logical(numpy.logical_and, [self, other])
+    def __rand__(self, other):
+        return _Logical(numpy.logical_and, [other, self])
+    def __or__(self, other):
+        return _Logical(numpy.logical_or, [self, other])
+    def __ror__(self, other):
+        return _Logical(numpy.logical_or, [other, self])
+    def __invert__(self):
+        return _Logical(numpy.logical_not, [self])
+
+    def __lt__(self, other):
+        return _Compare(numpy.less, self, other)
+    def __le__(self, other):
+        return _Compare(numpy.less_equal, self, other)
+    def __gt__(self, other):
+        return _Compare(numpy.greater, self, other)
+    def __ge__(self, other):
+        return _Compare(numpy.greater_equal, self, other)
+    def __eq__(self, other):
+        return _Compare(numpy.equal, self, other)
+    def __ne__(self, other):
+        return _Compare(numpy.not_equal, self, other)
+    # as __eq__ is overridden
+    __hash__ = object.__hash__
+
+    def __add__(self, other):
+        return _Ufunc(numpy.add, [self, other])
+    def __radd__(self, other):
+        return _Ufunc(numpy.add, [other, self])
+    def __sub__(self, other):
+        return _Ufunc(numpy.subtract, [self, other])
+    def __rsub__(self, other):
+        return _Ufunc(numpy.subtract, [other, self])
+    def __mul__(self, other):
+        return _Ufunc(numpy.multiply, [self, other])
+    def __rmul__(self, other):
+        return _Ufunc(numpy.multiply, [other, self])
+    def __truediv__(self, other):
+        return _Ufunc(numpy.true_divide, [self, other])
+    def __rtruediv__(self, other):
+        return _Ufunc(numpy.true_divide, [other, self])
+    def __neg__(self):
+        return _Ufunc(numpy.negative, [self])
+
+class _Array(Expr):
+    """
+    An image or stack
+    """
+    def __init__(self, array):
+        Expr.__init__(self, [])
+        if array.ndim not in (2, 3):
+            raise mdl.NotImageError("Expressions need images or stacks. Shape is %s" % (array.shape,))
+        self.array = array
+
+    def calc(self, values):
+        raise NotImplementedError("Arrays are sliced by evaluate()")
+
+class _Const(Expr):
+    """
+    A scalar value
+    """
+    def __init__(self, value):
+        Expr.__init__(self, [])
+        self.value = value
+
+    def calc(self, values):
+        return self.value
+
+class _Ufunc(Expr):
+    """
+    A numpy ufunc applied to the args
+    """
+    def __init__(self, ufunc, args):
+        Expr.__init__(self, args)
+        self.ufunc = ufunc
+
+    def calc(self, values):
+        return self.ufunc(*values)
+
+class _Compare(_Ufunc):
+    """
+    A comparison of two args
+    """
+    def __init__(self, ufunc, a, b):
+        _Ufunc.__init__(self, ufunc, [a, b])
+
+class _Logical(Expr):
+    """
+    logical_and or logical_or of any number of args, or logical_not
+    of one. Accumulates into one array rather than making a new one
+    for each arg.
+    """
+    def __init__(self, ufunc, args):
+        Expr.__init__(self, args)
+        self.ufunc = ufunc
+
+    def calc(self, values):
+        if self.ufunc is numpy.logical_not:
+            return numpy.logical_not(values[0])
+        if len(values) == 1:
+            return values[0]
+        result = self.ufunc(values[0], values[1])
+        for value in values[2:]:
+            if numpy.broadcast(result, value).shape == numpy.shape(result):
+                self.ufunc(result, value, out=result)
+            else:
+                result = self.ufunc(result, value)
+        return result
+
+class _Func(Expr):
+    """
+    One of the mdl functions. args are the expressions it is
+    called with, kwargs are passed as is.
+    """
+    def __init__(self, func, args, kwargs):
+        Expr.__init__(self, args)
+        self.func = func
+        self.kwargs = kwargs
+
+    def calc(self, values):
+        return self.func(*values, **self.kwargs)
+
+def asExpr(value):
+    """
+    Returns value wrapped as an expression, if it isn't already one.
+    value can be an image (2-d array), a stack (3-d array) or a scalar.
+    """
+    if isinstance(value, Expr):
+        return value
+    elif numpy.isscalar(value):
+        return _Const(value)
+    else:
+        return _Array(numpy.asarray(value))
+
+def and_list(conditionList):
+    """
+    Lazy version of mdl.and_list()
+    """
+    return _Logical(numpy.logical_and, list(conditionList))
+
+def or_list(conditionList):
+    """
+    Lazy version of mdl.or_list()
+    """
+    return _Logical(numpy.logical_or, list(conditionList))
+
+def pixinlist(img, valList):
+    """
+    Lazy version of mdl.pixinlist()
+    """
+    return _Func(mdl.pixinlist, [img], {'valList':valList})
+
+def stackwhere(mask, trueVal, falseVal, dtype=None):
+    """
+    Lazy version of mdl.stackwhere(). The output can be given
+    to evaluate().
+    """
+    return _Func(mdl.stackwhere, [mask, trueVal, falseVal], {'dtype':dtype})
+
+def stretch(imgLayer, numStdDev, minVal, maxVal, ignoreVal,
+        globalMean, globalStdDev, outputNullVal=0):
+    """
+    Lazy version of mdl.stretch(). globalMean and globalStdDev must be
+    given, as the stretch is done a chunk at a time.
+    """
+    return _Func(mdl.stretch, [imgLayer], {'numStdDev':numStdDev,
+        'minVal':minVal, 'maxVal':maxVal, 'ignoreVal':ignoreVal,
+        'globalMean':globalMean, 'globalStdDev':globalStdDev,
+        'outputNullVal':outputNullVal})
+
+def _getNodes(expr):
+    """
+    Returns a list of all the nodes in the expression, each once,
+    with every node after its args.
+    """
+    nodes = []
+    seen = set()
+    stack = [(expr, False)]
+    while len(stack) > 0:
+        (node, argsDone) = stack.pop()
+        if argsDone:
+            nodes.append(node)
+        elif id(node) not in seen:
+            seen.add(id(node))
+            stack.append((node, True))
+            for arg in reversed(node.args):
+                stack.append((arg, False))
+    return nodes
+
+def evaluate(expr, out=None, chunkBytes=CHUNK_BYTES, useNumexpr=False):
+    """
+    Calculates the expression, a chunk of rows at a time, into out
+    if given, otherwise a new array. See Expr.evaluate().
+    """
+    expr = asExpr(expr)
+    nodes = _getNodes(expr)
+    arrays = [node.array for node in nodes if isinstance(node, _Array)]
+    if len(arrays) == 0:
+        raise mdl.NotImageError("Expression doesn't use any images")
+    (nrows, ncols) = arrays[0].shape[-2:]
+    bytesPerRow = 0
+    for array in arrays:
+        if array.shape[-2:] != (nrows, ncols):
+            raise mdl.ShapeMismatchError("Image sizes differ: %s != %s" %
+                    (array.shape[-2:], (nrows, ncols)))
+        bytesPerRow += array.nbytes // max(nrows, 1)
+    chunkRows = max(1, chunkBytes // max(bytesPerRow, 1))
+
+    fuser = None
+    if useNumexpr and HAVE_NUMEXPR:
+        fuser = _NumexprFuser(nodes)
+
+    for startRow in range(0, max(nrows, 1), chunkRows):
+        rows = slice(startRow, min(startRow + chunkRows, nrows))
+        result = _evalChunk(expr, nodes, rows, fuser)
+        if out is None:
+            result = numpy.asarray(result)
+            out = numpy.empty(result.shape[:-2] + (nrows, ncols),
+                        dtype=result.dtype)
+        elif out.ndim < numpy.ndim(result) or out.shape[-2:] != (nrows, ncols):
+            raise mdl.ShapeMismatchError("out has shape %s, expression gives %s" %
+                    (out.shape, numpy.shape(result)[:-2] + (nrows, ncols)))
+        out[..., rows, :] = result
+    return out
+
+def _evalChunk(expr, nodes, rows, fuser):
+    """
+    Calculates the expression for the given slice of rows
+    """
+    values = {}
+    for node in nodes:
+        if isinstance(node, _Array):
+            values[id(node)] = node.array[..., rows, :]
+        elif fuser is not None and id(node) in fuser.fused:
+            # done as part of a numexpr expression
+            if node is expr or id(node) in fuser.roots:
+                values[id(node)] = fuser.calc(node, values)
+        else:
+            args = [values[id(arg)] for arg in node.args]
+            values[id(node)] = node.calc(args)
+    return values[id(expr)]
+
+class _NumexprFuser(object):
+    """
+    Works out which parts of the expression can be given to numexpr
+    and builds the numexpr expression strings for them. This is only
+    done for comparisons and logical operations, which give the same
+    answers as numpy - numexpr's arithmetic uses different types.
+    """
+    def __init__(self, nodes):
+        # the number of times each node is used
+        uses = {}
+        for node in nodes:
+            for arg in node.args:
+                uses[id(arg)] = uses.get(id(arg), 0) + 1
+
+        # ids of the nodes done by numexpr, and the ones that
+        # are the top of a numexpr expression
+        self.fused = set()
+        self.roots = set()
+        for node in nodes:
+            if isinstance(node, (_Compare, _Logical)):
+                self.fused.add(id(node))
+        for node in nodes:
+            if id(node) in self.fused:
+                for arg in node.args:
+                    # values used more than once are worked out once
+                    if id(arg) in self.fused and uses[id(arg)] > 1:
+                        self.roots.add(id(arg))
+        for node in nodes:
+            if id(node) in self.fused:
+                if uses.get(id(node), 0) == 0:
+                    self.roots.add(id(node))
+                else:
+                    # used by something numexpr doesn't do
+                    for user in nodes:
+                        if (id(node) in [id(arg) for arg in user.args] and
+                                id(user) not in self.fused):
+                            self.roots.add(id(node))
+
+    def calc(self, node, values):
+        """
+        Calculates node, and the fused nodes under it, for one chunk
+        """
+        localDict = {}
+        exprStr = self._build(node, values, localDict, True)
+        if len(localDict) == 0:
+            # no arrays - just constants
+            return node.calc([values[id(arg)] for arg in node.args])
+        return numexpr.evaluate(exprStr, local_dict=localDict)
+
+    def _input(self, value, localDict):
+        """
+        Adds an input value to localDict and returns its name
+        """
+        name = 'v%d' % len(localDict)
+        localDict[name] = value
+        return name
+
+    def _build(self, node, values, localDict, isTop):
+        """
+        Returns the numexpr string for node, adding the inputs to
+        localDict. Parts numexpr can't do the same as numpy are
+        calculated with numpy and become inputs.
+        """
+        if (not isTop and id(node) in self.roots) or id(node) not in self.fused:
+            return self._input(self._value(node, values), localDict)
+
+        if isinstance(node, _Compare):
+            (a, b) = [self._value(arg, values) for arg in node.args]
+            (a, b, ok) = _numexprCompareArgs(a, b)
+            if not ok:
+                return self._input(node.calc([a, b]), localDict)
+            return '(%s %s %s)' % (self._input(a, localDict),
+                    COMPARE_OPS[node.ufunc], self._input(b, localDict))
+
+        # logical - inputs which aren't already boolean need comparing
+        # with zero, as numexpr's & and | are bitwise
+        parts = []
+        for arg in node.args:
+            if id(arg) in self.fused and id(arg) not in self.roots:
+                parts.append(self._build(arg, values, localDict, False))
+            else:
+                value = self._value(arg, values)
+                if not _numexprType(value):
+                    value = numpy.asarray(value) != 0
+                name = self._input(value, localDict)
+                if numpy.asarray(value).dtype != numpy.bool_:
+                    name = '(%s != 0)' % name
+                parts.append(name)
+        if node.ufunc is numpy.logical_not:
+            return '(~%s)' % parts[0]
+        op = ' & ' if node.ufunc is numpy.logical_and else ' | '
+        return '(%s)' % op.join(parts)
+
+    def _value(self, node, values):
+        """
+        Returns the value of the given node for the current chunk,
+        calculating it if it is done by numexpr
+        """
+        if id(node) not in values:
+            values[id(node)] = self.calc(node, values)
+        return values[id(node)]
+
+def _numexprType(value):
+    """
+    Returns True if numexpr can use the type of value directly
+    """
+    dtype = numpy.asarray(value).dtype
+    return dtype.kind in 'bif' or (dtype.kind == 'u' and dtype.itemsize < 8)
+
+def _numexprCompareArgs(a, b):
+    """
+    Checks whether numexpr will compare a and b the same way as numpy,
+    converting constants to float32 where numpy would. Returns
+    (a, b, ok). This is conservative - where the types differ between 
+    arrays, or for integer arrays and float constants (which numpy may 
+    compare at float16), numpy is used instead.
+    """
+    aIsArray = isinstance(a, numpy.ndarray)
+    bIsArray = isinstance(b, numpy.ndarray)
+    if aIsArray and bIsArray:
+        ok = a.dtype == b.dtype and a.dtype.kind in 'iuf' and _numexprType(a)
+    elif aIsArray or bIsArray:
+        (array, const) = (a, b) if aIsArray else (b, a)
+        kind = array.dtype.kind
+        ok = False
+        if (isinstance(const, (int, float)) and not isinstance(const, bool) 
+                and _numexprType(array)):
+            if kind in 'iu':
+                ok = isinstance(const, int)
+            elif kind == 'f':
+                ok = True
+                if array.dtype == numpy.float32:
+                    const = numpy.float32(const)
+        (a, b) = (array, const) if aIsArray else (const, array)
+    else:
+        ok = False
+    return (a, b, ok)
@@ -18,54 +18,197 @@ Module for doing stats on rasters based on data from a vector
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+from multiprocessing import Pool
 import numpy
 from rios import applier
 from rios import pixelgrid
 from osgeo import gdal
 from osgeo import ogr
 from osgeo import osr
+from . import zones
 
 IGNORE_NONE = 0     # use all values in the raster
 IGNORE_INTERNAL = 1 # use internal value (if any)
 IGNORE_VALUES = 2   # value(s) will be specified
 
-def riosStats(info, inputs, output, otherargs):
+# name of the field in the in memory layer used for per feature
+# stats that holds the zone id for each feature
+ZONE_FIELD = 'ZONEID'
+# and the pass in which the feature is burnt in, so that
+# overlapping features are never burnt in together
+PASS_FIELD = 'ZONEPASS'
+
+# size of the cells, in pixels, that features are grouped into
+# for windowed per feature stats
+DEFAULT_GROUP_SIZE = 1024
+
+def getBands(inputs, otherargs):
     """
-    Function that gets called from RIOS
+    Returns the list of 1-based bands to process
     """
     if otherargs.bands is None:
         nbands = inputs.raster.shape[0]
         bands = numpy.arange(nbands) + 1 # 1 based
     else:
         bands = otherargs.bands
+    return bands
+
+def maskIgnored(info, inputs, otherargs, band, bandIdx, data, mask):
+    """
+    Returns mask with the pixels to be ignored in data set to False
+    """
+    if otherargs.ignore_behaviour == IGNORE_INTERNAL:
+        # we need to do more processing on 'mask'
+        nodata = info.getNoDataValueFor(inputs.raster, int(band))
+        if nodata is not None:
+            mask = mask & (data != nodata)
+    elif otherargs.ignore_behaviour == IGNORE_VALUES:
+        try:
+            nodata = otherargs.ignore_values[bandIdx]
+        except TypeError:
+            # not a sequence
+            nodata = otherargs.ignore_values
+        mask = mask & (data != nodata)
+    return mask
+
+def riosStats(info, inputs, output, otherargs):
+    """
+    Function that gets called from RIOS
+    """
+    bands = getBands(inputs, otherargs)
 
     bandIdx = 0 # for getting nodata values
     for band in bands:
         data = inputs.raster[band-1].flatten()
         mask = inputs.vector[0].flatten() != 0
-        if otherargs.ignore_behaviour == IGNORE_INTERNAL:
-            # we need to do more processing on 'mask'
-            nodata = info.getNoDataValueFor(inputs.raster, int(band))
-            if nodata is not None:
-                mask = mask & (data != nodata)
-        elif otherargs.ignore_behaviour == IGNORE_VALUES:
-            try:
-                nodata = otherargs.ignore_values[bandIdx]
-            except TypeError:
-                # not a sequence
-                nodata = otherargs.ignore_values
-            mask = mask & (data != nodata)
+        mask = maskIgnored(info, inputs, otherargs, band, bandIdx, data, mask)
 
         # mask the data
         data = data.compress(mask)
 
-        if band in otherargs.data:
-            otherargs.data[band] = numpy.append(otherargs.data[band], data)
+        if otherargs.exact:
+            # keep all the values - concatenated at the end
+            if band in otherargs.data:
+                otherargs.data[band].append(data)
+            else:
+                otherargs.data[band] = [data]
         else:
-            otherargs.data[band] = data
+            # everything is in the one zone
+            accumulateStats(otherargs, band, 
+                    numpy.zeros(data.shape, dtype=numpy.intp), data)
 
         bandIdx += 1
 
+def accumulateStats(otherargs, band, zoneIds, data):
+    """
+    Adds the data to the running moments and quantile accumulator
+    for the band, creating them on the first block. Integer data 
+    gets an exact histogram for the median, anything else a sketch.
+    """
+    if band not in otherargs.moments:
+        otherargs.moments[band] = zones.ZoneMoments()
+        if numpy.issubdtype(data.dtype, numpy.integer) and data.dtype.itemsize <= 4:
+            otherargs.quantiles[band] = zones.ZoneIntegerHistogram(data.dtype)
+        else:
+            otherargs.quantiles[band] = zones.ZoneQuantileSketch(
+                                        otherargs.relativeAccuracy)
+
+    otherargs.moments[band].update(zoneIds, data)
+    otherargs.quantiles[band].update(zoneIds, data)
+
+def getAccumulatedStats(otherargs, band, nZones):
+    """
+    Returns a list with a stats dictionary (as returned by doStats) 
+    for each zone of the accumulators for band. The 
+    dictionary is None for zones that had no data.
+    """
+    stats = otherargs.moments[band].getStats(nZones, (zones.STAT_MEAN, 
+                zones.STAT_STD, zones.STAT_MIN, zones.STAT_MAX, 
+                zones.STAT_COUNT))
+    medians = otherargs.quantiles[band].getQuantiles(nZones, [50])[0]
+
+    statsList = []
+    for zoneId in range(nZones):
+        count = int(stats[zones.STAT_COUNT][zoneId])
+        if count == 0:
+            statsList.append(None)
+        else:
+            statsList.append({'mean':stats[zones.STAT_MEAN][zoneId],
+                    'median':medians[zoneId], 'std':stats[zones.STAT_STD][zoneId],
+                    'min':stats[zones.STAT_MIN][zoneId], 
+                    'max':stats[zones.STAT_MAX][zoneId], 'count':count})
+    return statsList
+
+def rasterizeZones(info, inputs, otherargs):
+    """
+    Burns the zone ids of the features in otherargs.zoneLayer into
+    arrays matching the current block, one for each pass of 
+    features that don't overlap. Returns a list of the arrays for
+    the passes that have features touching the block, which is
+    empty if none do.
+    """
+    (ysize, xsize) = inputs.raster.shape[1:]
+    transform = info.getTransform()
+    (col, row) = info.getPixColRow(0, 0)
+    blockTransform = (transform[0] + col * transform[1], transform[1], 0.0,
+                        transform[3] + row * transform[5], 0.0, transform[5])
+
+    # only rasterize the features that touch this block
+    zoneLayer = otherargs.zoneLayer
+    zoneLayer.SetSpatialFilterRect(blockTransform[0], 
+                blockTransform[3] + ysize * blockTransform[5],
+                blockTransform[0] + xsize * blockTransform[1], blockTransform[3])
+    if zoneLayer.GetFeatureCount() == 0:
+        return []
+
+    driver = gdal.GetDriverByName('MEM')
+    zoneds = driver.Create('', xsize, ysize, 1, gdal.GDT_UInt32)
+    zoneds.SetGeoTransform(blockTransform)
+    zoneds.SetProjection(otherargs.rasterproj)
+    zoneBand = zoneds.GetRasterBand(1)
+
+    options = ['ATTRIBUTE=%s' % ZONE_FIELD]
+    if otherargs.alltouched:
+        options.append('ALL_TOUCHED=TRUE')
+
+    zoneIdsList = []
+    for npass in range(otherargs.nPasses):
+        if otherargs.nPasses > 1:
+            passFilter = '%s = %d' % (PASS_FIELD, npass)
+            if otherargs.zoneFilter is not None:
+                passFilter = '(%s) AND %s' % (otherargs.zoneFilter, passFilter)
+            zoneLayer.SetAttributeFilter(passFilter)
+            if zoneLayer.GetFeatureCount() == 0:
+                continue
+            zoneBand.Fill(0)
+        gdal.RasterizeLayer(zoneds, [1], zoneLayer, options=options)
+        zoneIdsList.append(zoneBand.ReadAsArray())
+
+    if otherargs.nPasses > 1:
+        zoneLayer.SetAttributeFilter(otherargs.zoneFilter)
+    del zoneds
+    return zoneIdsList
+
+def riosFeatureStats(info, inputs, output, otherargs):
+    """
+    Function that gets called from RIOS for per feature stats
+    """
+    bands = getBands(inputs, otherargs)
+
+    for zoneIds in rasterizeZones(info, inputs, otherargs):
+        zoneIds = zoneIds.flatten()
+
+        bandIdx = 0 # for getting nodata values
+        for band in bands:
+            data = inputs.raster[band-1].flatten()
+            mask = zoneIds != 0
+            mask = maskIgnored(info, inputs, otherargs, band, bandIdx, data, mask)
+
+            accumulateStats(otherargs, band, zoneIds.compress(mask), 
+                        data.compress(mask))
+
+            bandIdx += 1
+
 ROUND_DOWN = 0
 ROUND_UP = 1
 
@@ -140,10 +283,272 @@ def calcWorkingExtent(vector, raster, layer):
     del rasterds
 
     return pixgrid
-    
+
+def createZoneLayer(vector, raster, layer, sql=None, keyField=None,
+                        groupSize=None, alltouched=False):
+    """
+    Copies the features from the vector into an in memory layer
+    in the coordinate system of the raster, with a ZONE_FIELD 
+    attribute numbering the zones from 1. Features with the same key
+    (the FID, or the value of keyField) are in the same zone.
+
+    The zones are split into passes so that no two zones in a pass
+    share any pixels (with alltouched as for RasterizeLayer), and 
+    the PASS_FIELD attribute has the pass (from 0) for each feature.
+
+    If groupSize is given the features are grouped on a grid of cells
+    groupSize pixels square, by the centre of their bounding box, and 
+    numbered so each group has a consecutive range of zone ids.
+
+    Returns the in memory datasource, the layer, the projection and
+    transform of the raster, a list with the key for each zone id 
+    starting with zone id 1, a list of (startZone, endZone, extent) 
+    tuples, one per group, and the number of passes. endZone is one
+    past the last zone id in the group and extent is 
+    (xmin, xmax, ymin, ymax) for all the features in the group.
+    """
+    vectords = ogr.Open(vector)
+    if vectords is None:
+        raise IOError('Unable to read vector file %s' % vector)
+    vectorlyr = vectords.GetLayer(layer)
+    if sql is not None:
+        vectorlyr.SetAttributeFilter(sql)
+    vectorsr = vectorlyr.GetSpatialRef()
+
+    rasterds = gdal.Open(raster)
+    if rasterds is None:
+        raise IOError('Unable to read raster file %s' % raster)
+    rasterproj = rasterds.GetProjection()
+    if rasterproj is None or rasterproj == '':
+        raise ValueError('Raster must have projection set')
+    rastertransform = rasterds.GetGeoTransform()
+    del rasterds
+
+    rastersr = osr.SpatialReference(rasterproj)
+    transform = osr.CoordinateTransformation(vectorsr, rastersr)
+
+    # read the geometries, merging the features with the same key,
+    # so we can work out the groups before numbering them
+    zoneKeys = []
+    zoneGeoms = []  # list of geometries for each zone
+    zoneExtents = []
+    keyIndex = {}
+    for feature in vectorlyr:
+        geom = feature.GetGeometryRef()
+        if geom is None:
+            continue
+        geom = geom.Clone()
+        geom.Transform(transform)
+
+        if keyField is None:
+            key = feature.GetFID()
+        else:
+            key = feature.GetField(keyField)
+
+        (xmin, xmax, ymin, ymax) = geom.GetEnvelope()
+        if key in keyIndex:
+            idx = keyIndex[key]
+            zoneGeoms[idx].append(geom)
+            extent = zoneExtents[idx]
+            zoneExtents[idx] = (min(extent[0], xmin), max(extent[1], xmax), 
+                        min(extent[2], ymin), max(extent[3], ymax))
+        else:
+            keyIndex[key] = len(zoneKeys)
+            zoneKeys.append(key)
+            zoneGeoms.append([geom])
+            zoneExtents.append((xmin, xmax, ymin, ymax))
+
+    del vectords
+
+    groupCells = []
+    for (xmin, xmax, ymin, ymax) in zoneExtents:
+        if groupSize is None:
+            groupCells.append((0, 0))
+        else:
+            col = ((xmin + xmax) / 2.0 - rastertransform[0]) / rastertransform[1]
+            row = ((ymin + ymax) / 2.0 - rastertransform[3]) / rastertransform[5]
+            groupCells.append((int(numpy.floor(row / groupSize)), 
+                            int(numpy.floor(col / groupSize))))
+
+    passes = _zonePasses(zoneGeoms, zoneExtents, rastertransform, alltouched)
+
+    memds = ogr.GetDriverByName('Memory').CreateDataSource('zones')
+    memlyr = memds.CreateLayer('zones', rastersr, ogr.wkbUnknown)
+    memlyr.CreateField(ogr.FieldDefn(ZONE_FIELD, ogr.OFTInteger))
+    memlyr.CreateField(ogr.FieldDefn(PASS_FIELD, ogr.OFTInteger))
+    defn = memlyr.GetLayerDefn()
+
+    keys = []
+    groups = []
+    lastCell = None
+    order = sorted(range(len(zoneKeys)), key=lambda idx: groupCells[idx])
+    for idx in order:
+        zoneId = len(keys) + 1
+        for geom in zoneGeoms[idx]:
+            memfeature = ogr.Feature(defn)
+            memfeature.SetGeometry(geom)
+            memfeature.SetField(ZONE_FIELD, zoneId)
+            memfeature.SetField(PASS_FIELD, passes[idx])
+            memlyr.CreateFeature(memfeature)
+        keys.append(zoneKeys[idx])
+
+        (xmin, xmax, ymin, ymax) = zoneExtents[idx]
+        if len(groups) == 0 or groupCells[idx] != lastCell:
+            # start a new group
+            groups.append((zoneId, zoneId + 1, (xmin, xmax, ymin, ymax)))
+        else:
+            (startZone, endZone, extent) = groups[-1]
+            extent = (min(extent[0], xmin), max(extent[1], xmax), 
+                        min(extent[2], ymin), max(extent[3], ymax))
+            groups[-1] = (startZone, zoneId + 1, extent)
+        lastCell = groupCells[idx]
+
+    nPasses = max(passes) + 1 if len(passes) > 0 else 1
+    return memds, memlyr, rasterproj, rastertransform, keys, groups, nPasses
+
+def _zonePasses(zoneGeoms, zoneExtents, rastertransform, alltouched):
+    """
+    Returns a list with the pass for each zone, such that zones in
+    the same pass never burn in the same pixel. Each zone goes in the
+    first pass that has nothing overlapping it. 
+
+    Candidate pairs are found by sweeping along x over the extents, 
+    so only zones whose extents are close are compared. Without 
+    alltouched, zones which only touch along an edge don't share 
+    pixels. With it, zones less than a pixel apart can, so that is
+    treated as overlapping.
+    """
+    if alltouched:
+        margin = numpy.hypot(rastertransform[1], rastertransform[5])
+    else:
+        margin = 0.0
+
+    def overlaps(geoms, otherGeoms):
+        for geom in geoms:
+            for other in otherGeoms:
+                if alltouched:
+                    if geom.Distance(other) <= margin:
+                        return True
+                elif geom.Intersects(other) and not geom.Touches(other):
+                    return True
+        return False
+
+    order = sorted(range(len(zoneExtents)), key=lambda idx: zoneExtents[idx][0])
+    passes = [0] * len(zoneExtents)
+    active = []
+    for idx in order:
+        (xmin, xmax, ymin, ymax) = zoneExtents[idx]
+        active = [other for other in active 
+                    if zoneExtents[other][1] + margin >= xmin]
+        usedPasses = set()
+        for other in active:
+            otherExtent = zoneExtents[other]
+            if (otherExtent[2] - margin <= ymax and 
+                    otherExtent[3] + margin >= ymin and 
+                    passes[other] not in usedPasses and
+                    overlaps(zoneGeoms[idx], zoneGeoms[other])):
+                usedPasses.add(passes[other])
+        npass = 0
+        while npass in usedPasses:
+            npass += 1
+        passes[idx] = npass
+        active.append(idx)
+    return passes
+
+def pixgridForExtent(rasterproj, rastertransform, extent):
+    """
+    Returns a PixelGridDefn aligned with the raster that covers
+    extent (xmin, xmax, ymin, ymax) in the raster's coordinate system.
+    Always at least one pixel across.
+    """
+    (xmin, xmax, ymin, ymax) = extent
+    xres = rastertransform[1]
+    yres = abs(rastertransform[5])
+
+    xMin = rastertransform[0] + numpy.floor((xmin - rastertransform[0]) / xres) * xres
+    xMax = rastertransform[0] + numpy.ceil((xmax - rastertransform[0]) / xres) * xres
+    yMax = rastertransform[3] - numpy.floor((rastertransform[3] - ymax) / yres) * yres
+    yMin = rastertransform[3] - numpy.ceil((rastertransform[3] - ymin) / yres) * yres
+    if xMax <= xMin:
+        xMax = xMin + xres
+    if yMax <= yMin:
+        yMin = yMax - yres
+
+    pixgrid = pixelgrid.PixelGridDefn(projection=rasterproj, xMin=xMin,
+                        xMax=xMax, yMin=yMin, yMax=yMax, xRes=xres, yRes=yres)
+    return pixgrid
+
+def doStatsPixgrid(args):
+    """
+    Runs riosStats over the area of the given pixel grid. Called
+    by doStats(), possibly in a worker process. args is a tuple of
+    (vector, raster, pixgrid, sql, alltouched, layer, otherargs).
+    Returns otherargs with the accumulated stats.
+    """
+    (vector, raster, pixgrid, sql, alltouched, layer, otherargs) = args
+
+    infiles = applier.FilenameAssociations()
+    infiles.raster = raster
+    infiles.vector = vector
+
+    outfiles = applier.FilenameAssociations()
+    # empty
+
+    controls = applier.ApplierControls()
+    controls.setAlltouched(alltouched)
+    controls.setVectorlayer(layer)
+    if sql is not None:
+        controls.setFilterSQL(sql)
+    controls.referencePixgrid = pixgrid
+
+    applier.apply(riosStats, infiles, outfiles, otherargs, controls=controls)
+
+    return otherargs
+
+def mergeStats(otherargs, partial):
+    """
+    Merges the stats accumulated in the otherargs returned by a
+    worker into otherargs
+    """
+    for band in partial.moments.keys():
+        if band in otherargs.moments:
+            otherargs.moments[band].merge(partial.moments[band])
+            otherargs.quantiles[band].merge(partial.quantiles[band])
+        else:
+            otherargs.moments[band] = partial.moments[band]
+            otherargs.quantiles[band] = partial.quantiles[band]
+
+    for band in partial.data.keys():
+        if band in otherargs.data:
+            otherargs.data[band].extend(partial.data[band])
+        else:
+            otherargs.data[band] = partial.data[band]
+
+def splitPixgrid(pixgrid, numStrips):
+    """
+    Splits a PixelGridDefn into (at most) numStrips horizontal strips, 
+    each a whole number of RIOS blocks high.
+    """
+    windowysize = applier.ApplierControls().windowysize
+    nrows = int(round((pixgrid.yMax - pixgrid.yMin) / pixgrid.yRes))
+    nblocks = int(numpy.ceil(nrows / float(windowysize)))
+    stripRows = int(numpy.ceil(nblocks / float(numStrips))) * windowysize
+
+    strips = []
+    for startRow in range(0, nrows, stripRows):
+        endRow = min(startRow + stripRows, nrows)
+        strip = pixelgrid.PixelGridDefn(projection=pixgrid.projection, 
+                    xMin=pixgrid.xMin, xMax=pixgrid.xMax, 
+                    yMin=pixgrid.yMax - endRow * pixgrid.yRes, 
+                    yMax=pixgrid.yMax - startRow * pixgrid.yRes, 
+                    xRes=pixgrid.xRes, yRes=pixgrid.yRes)
+        strips.append(strip)
+    return strips
 
 def doStats(vector, raster, ignore_behaviour, ignore_values=None, 
-                sql=None, alltouched=False, bands=None, layer=0):
+                sql=None, alltouched=False, bands=None, layer=0,
+                exact=False, relativeAccuracy=zones.DEFAULT_RELATIVE_ACCURACY,
+                numProcs=1):
     """
     Does the stats and returns a dictionary of dictionaries
     one for each band - keyed on the band index.
@@ -169,22 +574,21 @@ def doStats(vector, raster, ignore_behaviour, ignore_values=None,
         to process.
     layer - by default the first layer in the vector is used. This can be
         set to either a number of a name of the vector layer to use.
+    exact - by default the stats are accumulated as each block is read
+        so only a small amount of memory is needed. The median is exact
+        for integer rasters but comes from a quantile sketch with the 
+        given relativeAccuracy for anything else. Setting this to True
+        keeps all the values in memory so the median is always exact.
+    numProcs - if greater than 1 the raster is split into strips that
+        are processed by a pool of this many processes and the 
+        partial results merged.
     """
-    infiles = applier.FilenameAssociations()
-    infiles.raster = raster
-    infiles.vector = vector
-
-    outfiles = applier.FilenameAssociations()
-    # empty
-
-    controls = applier.ApplierControls()
-    controls.setAlltouched(alltouched)
-    controls.setVectorlayer(layer)
-    if sql is not None:
-        controls.setFilterSQL(sql)
-
     otherargs = applier.OtherInputs()
     otherargs.data = {} # dictionary, keyed on band
+    otherargs.moments = {} # dictionary, keyed on band
+    otherargs.quantiles = {} # dictionary, keyed on band
+    otherargs.exact = exact
+    otherargs.relativeAccuracy = relativeAccuracy
     otherargs.bands = bands
     otherargs.ignore_behaviour = ignore_behaviour
     otherargs.ignore_values = ignore_values
@@ -195,15 +599,35 @@ def doStats(vector, raster, ignore_behaviour, ignore_values=None,
 
     # work out vector extent
     pixgrid = calcWorkingExtent(vector, raster, layer)
-    controls.referencePixgrid = pixgrid
 
     # do the work
-    applier.apply(riosStats, infiles, outfiles, otherargs, controls=controls)
+    if numProcs > 1:
+        argsList = [(vector, raster, stripPixgrid, sql, alltouched, layer, 
+                        otherargs) for stripPixgrid in 
+                        splitPixgrid(pixgrid, numProcs)]
+
+        pool = Pool(numProcs)
+        try:
+            partials = pool.map(doStatsPixgrid, argsList)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        for partial in partials:
+            mergeStats(otherargs, partial)
+    else:
+        doStatsPixgrid((vector, raster, pixgrid, sql, alltouched, layer, 
+                        otherargs))
 
     results = {}
+    for band in sorted(otherargs.moments.keys()):
+        stats = getAccumulatedStats(otherargs, band, 1)[0]
+        if stats is not None:
+            results[int(band)] = stats # make sure not a numpy type
+
     for band in sorted(otherargs.data.keys()):
         stats = {}
-        data = otherargs.data[band]
+        data = numpy.concatenate(otherargs.data[band])
         if data.size != 0:
             stats['mean'] = data.mean()
             stats['median'] = numpy.median(data)
@@ -214,3 +638,113 @@ def doStats(vector, raster, ignore_behaviour, ignore_values=None,
             results[int(band)] = stats # make sure not a numpy type
 
     return results
+
+def doStatsPerFeature(vector, raster, ignore_behaviour, ignore_values=None, 
+                sql=None, alltouched=False, bands=None, layer=0, 
+                keyField=None, 
+                relativeAccuracy=zones.DEFAULT_RELATIVE_ACCURACY,
+                windowed=False, groupSize=DEFAULT_GROUP_SIZE):
+    """
+    Does the stats separately for each feature in the vector, reading
+    the raster only once. Returns a dictionary keyed on the FID of each
+    feature, or on the value of the keyField attribute if given. Each
+    value is a dictionary keyed on band index, as returned by doStats().
+    Features with the same keyField value are treated as one, so the
+    stats are for all their pixels together.
+
+    The parameters are the same as doStats(). Each block has the
+    ids of the features that touch it burnt in, so the stats for every 
+    feature are accumulated at once. Where features overlap they are 
+    burnt in separately, in as few passes as possible, so each pixel 
+    counts towards all the features it is in, as it would for doStats()
+    on each. The median is exact for integer rasters but comes from a 
+    quantile sketch with the given relativeAccuracy for anything else.
+
+    By default the raster is read over the extent of the whole layer. 
+    If windowed is True the features are grouped on a grid of cells
+    groupSize pixels square and only the raster under the bounding box
+    of each group is read. This is much faster for small features
+    spread over a large raster.
+    """
+    infiles = applier.FilenameAssociations()
+    infiles.raster = raster
+
+    outfiles = applier.FilenameAssociations()
+    # empty
+
+    if ignore_behaviour == IGNORE_VALUES and ignore_values is None:
+        raise ValueError('must specify ignore_values when '+
+                        'ignore_behaviour = IGNORE_VALUES')
+
+    if not windowed:
+        groupSize = None
+    (zoneds, zoneLayer, rasterproj, rastertransform, keys, groups,
+            nPasses) = createZoneLayer(vector, raster, layer, sql, keyField, 
+                    groupSize, alltouched)
+
+    otherargs = applier.OtherInputs()
+    otherargs.zoneLayer = zoneLayer
+    otherargs.rasterproj = rasterproj
+    otherargs.alltouched = alltouched
+    otherargs.nPasses = nPasses
+    otherargs.zoneFilter = None
+    otherargs.moments = {} # dictionary, keyed on band
+    otherargs.quantiles = {} # dictionary, keyed on band
+    otherargs.relativeAccuracy = relativeAccuracy
+    otherargs.bands = bands
+    otherargs.ignore_behaviour = ignore_behaviour
+    otherargs.ignore_values = ignore_values
+
+    controls = applier.ApplierControls()
+    if windowed:
+        rasterds = gdal.Open(raster)
+        rasterExtent = (rastertransform[0], 
+            rastertransform[0] + rasterds.RasterXSize * rastertransform[1],
+            rastertransform[3] + rasterds.RasterYSize * rastertransform[5],
+            rastertransform[3])
+        del rasterds
+
+        for (startZone, endZone, extent) in groups:
+            # only bother with the bit of the group over the raster
+            extent = (max(extent[0], rasterExtent[0]), 
+                    min(extent[1], rasterExtent[1]),
+                    max(extent[2], rasterExtent[2]),
+                    min(extent[3], rasterExtent[3]))
+            if extent[0] > extent[1] or extent[2] > extent[3]:
+                continue
+
+            # only burn in the features in this group
+            otherargs.zoneFilter = ('%s >= %d AND %s < %d' % 
+                        (ZONE_FIELD, startZone, ZONE_FIELD, endZone))
+            zoneLayer.SetAttributeFilter(otherargs.zoneFilter)
+            controls.referencePixgrid = pixgridForExtent(rasterproj, 
+                        rastertransform, extent)
+
+            applier.apply(riosFeatureStats, infiles, outfiles, otherargs, 
+                    controls=controls)
+        otherargs.zoneFilter = None
+        zoneLayer.SetAttributeFilter(None)
+    else:
+        # work out vector extent
+        pixgrid = calcWorkingExtent(vector, raster, layer)
+        controls.referencePixgrid = pixgrid
+
+        # do the work
+        applier.apply(riosFeatureStats, infiles, outfiles, otherargs, 
+                    controls=controls)
+
+    results = {}
+    for key in keys:
+        results[key] = {}
+
+    nZones = len(keys) + 1
+    for band in sorted(otherargs.moments.keys()):
+        statsList = getAccumulatedStats(otherargs, band, nZones)
+        for zoneId in range(1, nZones):
+            stats = statsList[zoneId]
+            if stats is not None:
+                results[keys[zoneId - 1]][int(band)] = stats
+
+    del zoneds
+
+    return results
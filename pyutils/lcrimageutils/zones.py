@@ -21,11 +21,79 @@ Collection of routines that deals with zones
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import os
+import tempfile
+from multiprocessing import Pool
 import numpy
 from rios.imagereader import ImageReader
 
+def _growZoneArray(arr, size, fill=0):
+    """
+    Returns arr extended with fill so it has at least size elements. 
+    Grows by doubling so accumulators indexed on clump id 
+    aren't copied for every block.
+    """
+    if arr.size >= size:
+        return arr
+    newArr = numpy.empty((max(size, arr.size * 2),), dtype=arr.dtype)
+    newArr.fill(fill)
+    newArr[:arr.size] = arr
+    return newArr
+
+def _zoneMeansBlocks(args):
+    """
+    Reduces the given blocks of the clump and data files into a 
+    ZoneMoments object for each band. Called by zoneMeans(), possibly
+    in a worker process. args is a tuple of 
+    (clumpFile, dataFile, clumpBand, dataBands, ignoreDataVals, blockIndexes).
+    If blockIndexes is None all the blocks are done.
+    Returns a list of ZoneMoments objects, one per band.
+    """
+    (clumpFile, dataFile, clumpBand, dataBands, ignoreDataVals, 
+            blockIndexes) = args
+    fileDict = {'clumps':clumpFile, 'data':dataFile}
+
+    # accumulated values - one per dataBand
+    # created on the first block when we know how many bands
+    momentsList = None
+    
+    # red thru the images
+    reader = ImageReader(fileDict)
+    if blockIndexes is None:
+        blockIndexes = range(len(reader))
+
+    for nblock in blockIndexes:
+        (info, blocks) = reader.readBlock(nblock)
+        # get the data for the specified bands and flatten it
+        clumps = blocks['clumps'][clumpBand-1].ravel()
+
+        if dataBands is None:
+            # now we know how many bands there are for the default list
+            dataBands = range(1, blocks['data'].shape[0]+1)
+
+        if momentsList is None:
+            momentsList = [ZoneMoments(minMax=False) for band in dataBands]
+            if ignoreDataVals is not None and numpy.isscalar(ignoreDataVals):
+                # make list same size as dataBands
+                ignoreDataVals = [ignoreDataVals] * len(dataBands)
+
+        for idx, dataBand in enumerate(dataBands):
+
+            data = blocks['data'][dataBand-1].ravel()
+            bandClumps = clumps
+
+            # if we are ignoring values then drop those pixels
+            if ignoreDataVals is not None:
+                mask = data != ignoreDataVals[idx]
+                data = data.compress(mask)
+                bandClumps = clumps.compress(mask)
+
+            momentsList[idx].update(bandClumps, data)
+
+    return momentsList
+
 def zoneMeans(clumpFile, dataFile, clumpBand=1, dataBands=None, 
-                    ignoreDataVals=None):
+                    ignoreDataVals=None, numProcs=1):
     """
     Given a file of clumps and a file of data, calculates
     the mean and standard deviation for the area of each
@@ -43,122 +111,112 @@ def zoneMeans(clumpFile, dataFile, clumpBand=1, dataBands=None,
     Ignore values(s) may be passed in with the ignoreDataVals parameter.
     This may be a single value in which case the same is used for all 
     dataBands, or a sequence the same length as dataValues.
-    """
-    
-    fileDict = {'clumps':clumpFile, 'data':dataFile}
 
+    Each block is reduced with numpy.bincount into sum, sum of squares
+    and count arrays indexed on clump id, so the time taken doesn't 
+    depend on the number of clumps.
+
+    If numProcs is greater than 1 the blocks are shared between a pool 
+    of that many processes and the partial sums merged at the end.
+    """
     origdataBands = dataBands # so we know whether to return list or tuple
     if isinstance(dataBands, int):
         dataBands = [dataBands] # treat as list for now
 
-    if isinstance(ignoreDataVals, int):
-        # make list same size as dataBands
-        ignoreDataVals = [ignoreDataVals] * len(dataBands)
-
-    # use dictionaries for accumulated values
-    # index is the clump id
-    # we have a list of these dictionaries one per dataBand
-    sumDictList = []
-    sumsqDictList = []
-    countDictList = []
-    if dataBands is not None:
-        # if None, sorted below when we know how many bands
-        # create the dictionaries for each band
-        for dataBand in dataBands:
-            sumDictList.append({})
-            sumsqDictList.append({})
-            countDictList.append({})
-    
-    # red thru the images
-    reader = ImageReader(fileDict)
-    for (info, blocks) in reader:
-        # get the data for the specified bands and flatten it
-        clumps = blocks['clumps'][clumpBand-1].flatten()
+    if numProcs > 1:
+        fileDict = {'clumps':clumpFile, 'data':dataFile}
+        nBlocks = len(ImageReader(fileDict))
+        argsList = [(clumpFile, dataFile, clumpBand, dataBands, ignoreDataVals,
+                        blockIndexes) for blockIndexes in 
+                        splitBlocks(nBlocks, numProcs)]
 
-        if dataBands is None:
-            # now we know how many bands there are for the default list
-            dataBands = range(1, blocks['data'].shape[0]+1)
-            # create the dictionaries for each band
-            for dataBand in dataBands:
-                sumDictList.append({})
-                sumsqDictList.append({})
-                countDictList.append({})
+        pool = Pool(numProcs)
+        try:
+            partials = pool.map(_zoneMeansBlocks, argsList)
+        finally:
+            # don't leave workers running if one of them failed
+            pool.terminate()
+            pool.join()
 
-        for idx, dataBand in enumerate(dataBands):
+        momentsList = None
+        for partialList in partials:
+            if partialList is None:
+                continue
+            if momentsList is None:
+                momentsList = partialList
+            else:
+                for moments, partial in zip(momentsList, partialList):
+                    moments.merge(partial)
+    else:
+        momentsList = _zoneMeansBlocks((clumpFile, dataFile, clumpBand, 
+                            dataBands, ignoreDataVals, None))
 
-            data = blocks['data'][dataBand-1].flatten()
-            sumDict = sumDictList[dataBand-1]
-            sumsqDict = sumsqDictList[dataBand-1]
-            countDict = countDictList[dataBand-1]
-        
-            # for each clump id
-            for value in numpy.unique(clumps):
-                # get the data for that clump
-                mask = (clumps == value)
+    if momentsList is None:
+        # there weren't any blocks
+        if dataBands is None:
+            momentsList = []
+        else:
+            momentsList = [ZoneMoments(minMax=False) for band in dataBands]
 
-                # if we are ignoring values then extend mask
-                if ignoreDataVals is not None:
-                    mask = mask & (data != ignoreDataVals[idx])
-
-                dataSubset = data.compress(mask)
-                # check we have data
-                if dataSubset.size != 0:
-                    # calculate the values
-                    sum = dataSubset.sum()
-                    sq = dataSubset * dataSubset
-                    sumsq = sq.sum()
-
-                    # check if we encountered this value or not
-                    # and load into our dictioanaries
-                    if value in sumDict:
-                        sumDict[value] += sum
-                        sumsqDict[value] += sumsq
-                        countDict[value] += dataSubset.size
-                    else:
-                        sumDict[value] = sum
-                        sumsqDict[value] = sumsq
-                        countDict[value] = dataSubset.size
-                
-    # work out the length of the arrays and 
-    # create some blank arrays
-    maxidx = max(sumDict.keys()) + 1
-    meanArray = numpy.zeros((maxidx,), numpy.float)
-    stdArray = numpy.zeros((maxidx,), numpy.float)
+    # work out the length of the arrays - up to the 
+    # highest clump that had data
+    maxidx = 0
+    for moments in momentsList:
+        nonZero = moments.count.nonzero()[0]
+        if nonZero.size > 0:
+            maxidx = max(maxidx, nonZero[-1] + 1)
 
     resultList = []
     # go through each band    
-    for dataBand in dataBands:
-        sumDict = sumDictList[dataBand-1]
-        sumsqDict = sumsqDictList[dataBand-1]
-        countDict = countDictList[dataBand-1]
-
-        # turn into arrays so we don't have to iterate
-        idxs = numpy.fromiter(sumDict.keys(), numpy.integer)
-        sums = numpy.zeros((maxidx,), numpy.float)
-        sums[idxs] = numpy.fromiter(sumDict.values(), numpy.float)
-        sumsqs = numpy.zeros((maxidx,), numpy.float)
-        sumsqs[idxs] = numpy.fromiter(sumsqDict.values(), numpy.float)
-        counts = numpy.zeros((maxidx,), numpy.integer)
-        counts[idxs] = numpy.fromiter(countDict.values(), numpy.integer)
-
-        # mask out invalid divides
-        outInvalid = counts == 0
-        counts[outInvalid] = 1
-
-        means = sums / counts
-        stds = numpy.sqrt((sumsqs / counts) - (means * means))
-
-        means[outInvalid] = 0
-        stds[outInvalid] = 0
-        
-        resultList.append((means, stds))
+    for moments in momentsList:
+        stats = moments.getStats(maxidx, (STAT_MEAN, STAT_STD))
+        resultList.append((stats[STAT_MEAN], stats[STAT_STD]))
             
     if isinstance(origdataBands, int):
         return resultList[0] # only one item
     else:
         return resultList
+
+def splitBlocks(nBlocks, numProcs):
+    """
+    Splits the block indexes into runs of consecutive blocks to be
+    shared between numProcs processes. Makes a few runs per
+    process so they stay busy if some runs are slower than others.
+    Returns a list of ranges of block indexes, to be read with 
+    ImageReader.readBlock(). Used by zoneMeans() and 
+    imagestats.getGlobalStats().
+    """
+    nRuns = min(nBlocks, numProcs * 4)
+    bounds = numpy.linspace(0, nBlocks, nRuns + 1).astype(int)
+    return [range(bounds[n], bounds[n + 1]) for n in range(nRuns)]
         
-def zoneMajority(clumpFile, dataFile, clumpBand=1, dataBands=None):
+# types of histogram zoneMajority can return
+HISTOGRAM_DICT = 0  # dictionary of dictionaries keyed on clump id and value
+HISTOGRAM_CSR = 1   # (indptr, values, counts) arrays
+HISTOGRAM_NONE = 2  # no histogram
+
+# the packed keys used by zoneMajority have the clump id in the 
+# upper 32 bits and the data value in the lower 32 bits
+PACKED_VALUE_BITS = 32
+PACKED_VALUE_MASK = 2**PACKED_VALUE_BITS - 1
+
+# don't bother merging pending keys into the accumulated ones until
+# there are at least this many of them
+MIN_PENDING_KEYS = 2**20
+
+def _mergeKeyCounts(keysList, countsList):
+    """
+    Merges lists of sorted unique keys and their counts into
+    a single sorted array of unique keys and their total counts.
+    """
+    allKeys = numpy.concatenate(keysList)
+    allCounts = numpy.concatenate(countsList)
+    keys, inverse = numpy.unique(allKeys, return_inverse=True)
+    counts = numpy.bincount(inverse, weights=allCounts).astype(numpy.int64)
+    return keys, counts
+
+def zoneMajority(clumpFile, dataFile, clumpBand=1, dataBands=None, 
+                    histType=HISTOGRAM_DICT):
     """
     Given a file of clumps and a file of data, calculates
     the most common data values for each clump and the histogram
@@ -168,11 +226,25 @@ def zoneMajority(clumpFile, dataFile, clumpBand=1, dataBands=None):
     Each tuple contains as array of the most common values and a histogram. 
     The indices of this array go from zero to the maximum clump value 
     and have values for each clump id, zero for other indices.
-    The histogram is a dictionary, keyed on the clump id. Each value
-    in the dictionary is itself a dictionary keyed on the data value,
-    with the count of that value.
+    Where values are equally common the lowest is used.
     If dataBands is a single integer, returns a tuple with the mode array and
-    histogram dictionary as above.
+    histogram as above.
+
+    The type of histogram depends on histType:
+        HISTOGRAM_DICT - a dictionary, keyed on the clump id. Each value
+            in the dictionary is itself a dictionary keyed on the data value,
+            with the count of that value.
+        HISTOGRAM_CSR - a tuple of (indptr, values, counts) arrays. The
+            values found in clump i, and their counts, are 
+            values[indptr[i]:indptr[i+1]] and counts[indptr[i]:indptr[i+1]]
+            with the values in increasing order.
+        HISTOGRAM_NONE - None. Use this if only the mode is needed.
+
+    The data must be non-negative integers less than 2^32. Each 
+    (clump id, value) pair is packed into a single 64 bit key and 
+    the counts of these are accumulated as sorted unique arrays, so 
+    memory is proportional to the number of distinct pairs 
+    rather than the number of clumps times the number of values.
     """
 
     origdataBands = dataBands # so we know whether to return list or tuple
@@ -181,84 +253,707 @@ def zoneMajority(clumpFile, dataFile, clumpBand=1, dataBands=None):
     
     fileDict = {'clumps':clumpFile, 'data':dataFile}
     
-    # index is the clump id
-    # list of dictionaries
-    clumpDictList = []
-    if dataBands is not None:
-        # if None, sorted below when we know how many bands
-        # create the dictionaries for each band
-        for dataBand in dataBands:
-            clumpDictList.append({})
+    # accumulated keys and counts for each band
+    # plus keys and counts from blocks not yet merged into them
+    # created on the first block when we know how many bands
+    keysList = None
+    countsList = None
+    pendingKeysList = None
+    pendingCountsList = None
+    dataTypes = None
 
     # red thru the images
     reader = ImageReader(fileDict)
     for (info, blocks) in reader:
         # get the data for the specified bands and flatten it
-        clumps = blocks['clumps'][clumpBand-1].flatten()
+        clumps = blocks['clumps'][clumpBand-1].ravel().astype(numpy.uint64)
+        clumpKeys = clumps << numpy.uint64(PACKED_VALUE_BITS)
 
         if dataBands is None:
             # now we know how many bands there are for the default list
             dataBands = range(1, blocks['data'].shape[0]+1)
-            # create the dictionaries for each band
-            for dataBand in dataBands:
-                clumpDictList.append({})
 
-        for dataBand in dataBands:
+        if keysList is None:
+            keysList = [numpy.zeros((0,), numpy.uint64) for band in dataBands]
+            countsList = [numpy.zeros((0,), numpy.int64) for band in dataBands]
+            pendingKeysList = [[] for band in dataBands]
+            pendingCountsList = [[] for band in dataBands]
+            dataTypes = [blocks['data'].dtype for band in dataBands]
 
-            data = blocks['data'][dataBand-1].flatten()
-            clumpDict = clumpDictList[dataBand-1]
-        
-            # for each clump id
-            for value in numpy.unique(clumps):
-                # get the data for that clump
-                dataSubset = data.compress(clumps == value)
-                # check we have data
-                if dataSubset.size != 0:
-                    # do we have this value in histDict?
-                    if value in clumpDict:
-                        # yes, retrieve dict
-                        histDict = clumpDict[value]
-                    else:
-                        # no, create it and set it
-                        histDict = {}
-                        clumpDict[value] = histDict
-
-                    # do the bincount
-                    bincount = numpy.bincount(dataSubset)
-                    # turn this into a dictionary
-                    bins = numpy.arange(bincount.size)
-                    # only interested in values where count != 0
-                    bins = numpy.compress(bincount != 0, bins)
-                    bincount = numpy.compress(bincount != 0, bincount)
-
-                    for count in range(bins.size):
-                        binvalue = bins[count]
-                        if binvalue in histDict:
-                            histDict[binvalue] += bincount[count]
-                        else:
-                            histDict[binvalue] = bincount[count]
+        for idx, dataBand in enumerate(dataBands):
+
+            data = blocks['data'][dataBand-1].ravel()
+            if data.size == 0:
+                continue
+            if not numpy.issubdtype(data.dtype, numpy.integer):
+                raise TypeError('zoneMajority only works on integer data')
+            if data.min() < 0 or data.max() > PACKED_VALUE_MASK:
+                raise ValueError('zoneMajority needs data between 0 and %d' % 
+                                    PACKED_VALUE_MASK)
+
+            keys = clumpKeys | data.astype(numpy.uint64)
+            blockKeys, blockCounts = numpy.unique(keys, return_counts=True)
+
+            pendingKeys = pendingKeysList[idx]
+            pendingCounts = pendingCountsList[idx]
+            pendingKeys.append(blockKeys)
+            pendingCounts.append(blockCounts)
+
+            # only merge once the pending keys are as big as the 
+            # accumulated ones so each key is merged a limited number of times
+            nPending = sum([pending.size for pending in pendingKeys])
+            if nPending >= max(keysList[idx].size, MIN_PENDING_KEYS):
+                keysList[idx], countsList[idx] = _mergeKeyCounts(
+                    [keysList[idx]] + pendingKeys, 
+                    [countsList[idx]] + pendingCounts)
+                del pendingKeys[:]
+                del pendingCounts[:]
                 
     resultList = []
-    for dataBand in dataBands:
+    for idx, dataBand in enumerate(dataBands):
+        keys, counts = _mergeKeyCounts(
+                    [keysList[idx]] + pendingKeysList[idx], 
+                    [countsList[idx]] + pendingCountsList[idx])
+
+        clumpIds = (keys >> numpy.uint64(PACKED_VALUE_BITS)).astype(numpy.intp)
+        values = (keys & numpy.uint64(PACKED_VALUE_MASK)).astype(dataTypes[idx])
+
         # work out the length of the arrays and 
         # create a blank arrays
-        maxidx = max(clumpDict.keys()) + 1
+        maxidx = 0
+        if clumpIds.size > 0:
+            maxidx = clumpIds[-1] + 1
         modeArray = numpy.zeros((maxidx,), numpy.uint32)
-    
-        # go thru each value
-        for value in clumpDict.keys():
-            # find the mode
-            histDict = clumpDict[value]
-            maxValue, maxCount = max(histDict.items(), key=lambda x:x[1])
 
-            modeArray[value] = maxValue
+        # sort by clump, then most common first, then lowest value first
+        # and take the first for each clump
+        order = numpy.lexsort((values, -counts, clumpIds))
+        sortedClumpIds = clumpIds[order]
+        first = numpy.ones(order.shape, dtype=bool)
+        first[1:] = sortedClumpIds[1:] != sortedClumpIds[:-1]
+        modeArray[sortedClumpIds[first]] = values[order[first]]
 
-        resultList.append((modeArray, clumpDict))
+        if histType == HISTOGRAM_NONE:
+            hist = None
+        else:
+            # keys are sorted so values within each clump are together
+            indptr = numpy.zeros((maxidx + 1,), numpy.int64)
+            indptr[1:] = numpy.bincount(clumpIds, minlength=maxidx).cumsum()
+
+            if histType == HISTOGRAM_CSR:
+                hist = (indptr, values, counts)
+            else:
+                hist = {}
+                for clumpId in numpy.unique(clumpIds):
+                    start = indptr[clumpId]
+                    end = indptr[clumpId + 1]
+                    hist[clumpId] = dict(zip(values[start:end], 
+                                    counts[start:end]))
+
+        resultList.append((modeArray, hist))
+            
+    if isinstance(origdataBands, int):
+        return resultList[0] # only one item
+    else:
+        return resultList
+
+# statistics that zoneStats can calculate
+STAT_COUNT = 'count'
+STAT_SUM = 'sum'
+STAT_MEAN = 'mean'
+STAT_STD = 'std'
+STAT_MIN = 'min'
+STAT_MAX = 'max'
+STAT_RANGE = 'range'
+STAT_MEDIAN = 'median'
+STAT_PERCENTILES = 'percentiles'
+
+MOMENT_STATS = (STAT_COUNT, STAT_SUM, STAT_MEAN, STAT_STD, STAT_MIN, 
+                    STAT_MAX, STAT_RANGE)
+QUANTILE_STATS = (STAT_MEDIAN, STAT_PERCENTILES)
+
+# default memory zoneStats can use to hold values for the exact
+# order statistics before it spills them to disk
+DEFAULT_MAX_MEMORY = 2**30
+
+# default relative accuracy of the quantile sketches
+DEFAULT_RELATIVE_ACCURACY = 0.01
+
+def _zoneStarts(sortedZones):
+    """
+    Given a sorted array of zone ids returns the zone ids present and
+    the index of the start of each in sortedZones.
+    """
+    isStart = numpy.ones(sortedZones.shape, dtype=bool)
+    isStart[1:] = sortedZones[1:] != sortedZones[:-1]
+    starts = isStart.nonzero()[0]
+    return sortedZones[starts], starts
+
+class ZoneMoments(object):
+    """
+    Running count, sum, sum of squares, minimum and maximum of
+    the data in each zone. Each is an array indexed on the zone id.
+    Objects can be merged, so partial results from different 
+    blocks can be combined.
+    """
+    def __init__(self, minMax=True):
+        """
+        If minMax is False the minimum and maximum aren't calculated
+        which saves sorting each block.
+        """
+        self.minMax = minMax
+        self.count = numpy.zeros((0,), numpy.int64)
+        self.sum = numpy.zeros((0,), numpy.float64)
+        self.sumsq = numpy.zeros((0,), numpy.float64)
+        self.min = numpy.zeros((0,), numpy.float64)
+        self.max = numpy.zeros((0,), numpy.float64)
+
+    def grow(self, nZones):
+        """
+        Make sure the arrays have room for nZones zones
+        """
+        self.count = _growZoneArray(self.count, nZones)
+        self.sum = _growZoneArray(self.sum, nZones)
+        self.sumsq = _growZoneArray(self.sumsq, nZones)
+        self.min = _growZoneArray(self.min, nZones, numpy.inf)
+        self.max = _growZoneArray(self.max, nZones, -numpy.inf)
+
+    def update(self, zones, data):
+        """
+        Add the data to the totals. zones is an array of 
+        non-negative integer zone ids the same shape as data.
+        """
+        if zones.size == 0:
+            return
+        zones = zones.astype(numpy.intp)
+        data = data.astype(numpy.float64)
+        nZones = zones.max() + 1
+        self.grow(nZones)
+
+        self.count[:nZones] += numpy.bincount(zones, minlength=nZones)
+        self.sum[:nZones] += numpy.bincount(zones, weights=data, 
+                                minlength=nZones)
+        self.sumsq[:nZones] += numpy.bincount(zones, weights=data * data, 
+                                minlength=nZones)
+
+        if self.minMax:
+            order = numpy.argsort(zones, kind='mergesort')
+            sortedData = data[order]
+            presentZones, starts = _zoneStarts(zones[order])
+            self.min[presentZones] = numpy.minimum(self.min[presentZones], 
+                            numpy.minimum.reduceat(sortedData, starts))
+            self.max[presentZones] = numpy.maximum(self.max[presentZones], 
+                            numpy.maximum.reduceat(sortedData, starts))
+
+    def merge(self, other):
+        """
+        Add the totals from another ZoneMoments object into this one
+        """
+        nZones = other.count.size
+        self.grow(nZones)
+        self.count[:nZones] += other.count
+        self.sum[:nZones] += other.sum
+        self.sumsq[:nZones] += other.sumsq
+        self.min[:nZones] = numpy.minimum(self.min[:nZones], other.min)
+        self.max[:nZones] = numpy.maximum(self.max[:nZones], other.max)
+
+    def getStats(self, nZones, stats):
+        """
+        Returns a dictionary of arrays, keyed on the name of each
+        of the requested moment statistics. Each array has nZones 
+        elements and is zero for zones with no data.
+        """
+        self.grow(nZones)
+        count = self.count[:nZones]
+        outInvalid = count == 0
+        safeCount = numpy.where(outInvalid, 1, count)
+
+        results = {}
+        for stat in stats:
+            if stat == STAT_COUNT:
+                result = count.copy()
+            elif stat == STAT_SUM:
+                result = self.sum[:nZones].copy()
+            elif stat == STAT_MEAN:
+                result = self.sum[:nZones] / safeCount
+            elif stat == STAT_STD:
+                means = self.sum[:nZones] / safeCount
+                variances = (self.sumsq[:nZones] / safeCount) - (means * means)
+                result = numpy.sqrt(numpy.maximum(variances, 0))
+            elif stat == STAT_MIN:
+                result = self.min[:nZones].copy()
+            elif stat == STAT_MAX:
+                result = self.max[:nZones].copy()
+            elif stat == STAT_RANGE:
+                result = self.max[:nZones] - self.min[:nZones]
+            else:
+                continue
+            result[outInvalid] = 0
+            results[stat] = result
+        return results
+
+def _interpolateQuantiles(zoneCounts, percentiles, getOrderStat):
+    """
+    Works out the requested percentiles for each zone, interpolating
+    between order statistics in the same way as numpy.percentile.
+    zoneCounts is the number of values in each zone present and 
+    getOrderStat(ranks) returns the value of the given (0-based) order 
+    statistic within each of these zones. 
+    Returns an array of shape (len(percentiles), len(zoneCounts)).
+    """
+    result = numpy.empty((len(percentiles), zoneCounts.size), numpy.float64)
+    for idx, percentile in enumerate(percentiles):
+        position = (zoneCounts - 1) * (percentile / 100.0)
+        lower = numpy.floor(position).astype(numpy.int64)
+        upper = numpy.ceil(position).astype(numpy.int64)
+        lowerVals = getOrderStat(lower)
+        upperVals = getOrderStat(upper)
+        result[idx] = lowerVals + (upperVals - lowerVals) * (position - lower)
+    return result
+
+class ZoneValueStore(object):
+    """
+    Keeps every (zone, value) pair so exact order statistics can be 
+    found for each zone. Once the pairs take more than maxMemory bytes
+    they are spilled to temporary files in tempDir, partitioned on the
+    zone id so each file can be processed on its own at the end.
+    Call close() to remove the temporary files.
+    """
+    PAIR_DTYPE = numpy.dtype([('zone', numpy.int64), ('value', numpy.float64)])
+
+    def __init__(self, maxMemory=DEFAULT_MAX_MEMORY, tempDir='.', 
+                    expectedSize=None):
+        """
+        expectedSize is the total number of values expected (if known)
+        and is used to decide how many files to spill into.
+        """
+        self.maxMemory = maxMemory
+        self.tempDir = tempDir
+        self.expectedSize = expectedSize
+        self.pairs = []
+        self.nbytes = 0
+        self.spillFiles = None
+
+    def update(self, zones, data):
+        """
+        Add the values in data to the store. zones is an array of 
+        non-negative integer zone ids the same shape as data.
+        """
+        if zones.size == 0:
+            return
+        pairs = numpy.empty(zones.shape, dtype=self.PAIR_DTYPE)
+        pairs['zone'] = zones
+        pairs['value'] = data
+        self.addPairs(pairs)
+
+    def addPairs(self, pairs):
+        """
+        Add an array of PAIR_DTYPE records to the store
+        """
+        if self.spillFiles is not None:
+            self.spill(pairs)
+        else:
+            self.pairs.append(pairs)
+            self.nbytes += pairs.nbytes
+            if self.nbytes > self.maxMemory:
+                self.startSpill()
+
+    def merge(self, other):
+        """
+        Add the values from another ZoneValueStore into this one.
+        """
+        for pairs in other.iterPartitions():
+            self.addPairs(pairs)
+
+    def startSpill(self):
+        """
+        Create the temporary files and move what is in memory into them
+        """
+        if self.expectedSize is not None:
+            expectedBytes = self.expectedSize * self.PAIR_DTYPE.itemsize
+        else:
+            # assume we are about half way
+            expectedBytes = self.nbytes * 2
+        nFiles = max(int(numpy.ceil(expectedBytes / float(self.maxMemory))), 2)
+
+        self.spillFiles = []
+        for n in range(nFiles):
+            fileh, spillFile = tempfile.mkstemp('.zonevals', dir=self.tempDir)
+            os.close(fileh)
+            self.spillFiles.append(spillFile)
+
+        pairs = numpy.concatenate(self.pairs)
+        self.pairs = []
+        self.nbytes = 0
+        self.spill(pairs)
+
+    def spill(self, pairs):
+        """
+        Append pairs to the temporary files, partitioned on zone id
+        """
+        nFiles = len(self.spillFiles)
+        partition = pairs['zone'] % nFiles
+        order = numpy.argsort(partition, kind='mergesort')
+        pairs = pairs[order]
+        bounds = numpy.searchsorted(partition[order], numpy.arange(nFiles + 1))
+        for n in range(nFiles):
+            if bounds[n + 1] > bounds[n]:
+                with open(self.spillFiles[n], 'ab') as f:
+                    pairs[bounds[n]:bounds[n + 1]].tofile(f)
+
+    def iterPartitions(self):
+        """
+        Yields arrays of PAIR_DTYPE records. All the values for a 
+        given zone are in the same array.
+        """
+        if self.spillFiles is None:
+            if len(self.pairs) > 0:
+                yield numpy.concatenate(self.pairs)
+        else:
+            for spillFile in self.spillFiles:
+                yield numpy.fromfile(spillFile, dtype=self.PAIR_DTYPE)
+
+    def getQuantiles(self, nZones, percentiles):
+        """
+        Returns an array of shape (len(percentiles), nZones) with the
+        exact percentiles for each zone. Zero for zones with no data.
+        """
+        result = numpy.zeros((len(percentiles), nZones), numpy.float64)
+        for pairs in self.iterPartitions():
+            if pairs.size == 0:
+                continue
+            order = numpy.lexsort((pairs['value'], pairs['zone']))
+            sortedZones = pairs['zone'][order]
+            sortedValues = pairs['value'][order]
+            presentZones, starts = _zoneStarts(sortedZones)
+            zoneCounts = numpy.diff(numpy.append(starts, sortedZones.size))
+
+            def getOrderStat(ranks):
+                return sortedValues[starts + ranks]
+
+            inRange = presentZones < nZones
+            quantiles = _interpolateQuantiles(zoneCounts, percentiles, 
+                                    getOrderStat)
+            result[:, presentZones[inRange]] = quantiles[:, inRange]
+        return result
+
+    def close(self):
+        """
+        Remove any temporary files
+        """
+        if self.spillFiles is not None:
+            for spillFile in self.spillFiles:
+                if os.path.exists(spillFile):
+                    os.remove(spillFile)
+            self.spillFiles = None
+        self.pairs = []
+
+class ZoneKeyCounts(object):
+    """
+    Base class for accumulators that count how many times each 
+    (zone, key) pair occurs, where the key is an integer derived 
+    from the data value that sorts in the same order as the values. 
+    Each pair is packed into a single 64 bit integer 
+    (zone * nKeysPerZone + key) and the counts are held as sorted 
+    unique arrays. Memory is proportional to the number of distinct 
+    pairs. Subclasses set nKeysPerZone and implement valueKeys() and 
+    keyValues().
+    """
+    nKeysPerZone = None
+
+    def __init__(self):
+        self.keys = numpy.zeros((0,), numpy.int64)
+        self.counts = numpy.zeros((0,), numpy.int64)
+        self.pendingKeys = []
+        self.pendingCounts = []
+
+    def valueKeys(self, data):
+        """
+        Returns an int64 array of the keys for the values in data
+        """
+        raise NotImplementedError()
+
+    def keyValues(self, keys):
+        """
+        Returns a float64 array of the values represented by keys
+        """
+        raise NotImplementedError()
+
+    def update(self, zones, data):
+        """
+        Add the values in data. zones is an array of 
+        non-negative integer zone ids the same shape as data.
+        """
+        if zones.size == 0:
+            return
+        keys = zones.astype(numpy.int64) * self.nKeysPerZone + self.valueKeys(data)
+        blockKeys, blockCounts = numpy.unique(keys, return_counts=True)
+        self.addCounts(blockKeys, blockCounts.astype(numpy.int64))
+
+    def addCounts(self, keys, counts):
+        """
+        Add sorted unique packed keys and their counts. They are 
+        only merged once the pending keys are as big as the 
+        accumulated ones so each key is merged a limited number of times.
+        """
+        self.pendingKeys.append(keys)
+        self.pendingCounts.append(counts)
+        nPending = sum([pending.size for pending in self.pendingKeys])
+        if nPending >= max(self.keys.size, MIN_PENDING_KEYS):
+            self.finish()
+
+    def merge(self, other):
+        """
+        Add the counts from another object of the same type into this one.
+        """
+        other.finish()
+        self.addCounts(other.keys, other.counts)
+
+    def finish(self):
+        """
+        Merge any pending keys into the accumulated ones.
+        """
+        if len(self.pendingKeys) > 0:
+            self.keys, self.counts = _mergeKeyCounts(
+                        [self.keys] + self.pendingKeys, 
+                        [self.counts] + self.pendingCounts)
+            self.pendingKeys = []
+            self.pendingCounts = []
+
+    def getQuantiles(self, nZones, percentiles):
+        """
+        Returns an array of shape (len(percentiles), nZones) with the
+        percentiles for each zone. Zero for zones with no data.
+        """
+        self.finish()
+        result = numpy.zeros((len(percentiles), nZones), numpy.float64)
+        if self.keys.size == 0:
+            return result
+
+        presentZones, starts = _zoneStarts(self.keys // self.nKeysPerZone)
+        cumCounts = self.counts.cumsum()
+        zoneCounts = numpy.add.reduceat(self.counts, starts)
+        countBefore = cumCounts[starts] - self.counts[starts]
+
+        def getOrderStat(ranks):
+            idx = numpy.searchsorted(cumCounts, countBefore + ranks, side='right')
+            return self.keyValues(self.keys[idx] % self.nKeysPerZone)
+
+        inRange = presentZones < nZones
+        quantiles = _interpolateQuantiles(zoneCounts, percentiles, getOrderStat)
+        result[:, presentZones[inRange]] = quantiles[:, inRange]
+        return result
+
+    def close(self):
+        pass
+
+class ZoneIntegerHistogram(ZoneKeyCounts):
+    """
+    Exact counts of each integer value in each zone, giving exact
+    quantiles for integer data in memory proportional to the number
+    of distinct (zone, value) pairs. Only works for integer types 
+    of 32 bits or less - use ZoneQuantileSketch for anything else.
+    """
+    def __init__(self, dtype):
+        ZoneKeyCounts.__init__(self)
+        dtype = numpy.dtype(dtype)
+        if not numpy.issubdtype(dtype, numpy.integer) or dtype.itemsize > 4:
+            raise TypeError('ZoneIntegerHistogram needs an integer type ' +
+                            'of 32 bits or less, not %s' % dtype)
+        iinfo = numpy.iinfo(dtype)
+        self.minValue = int(iinfo.min)
+        self.nKeysPerZone = int(iinfo.max) - self.minValue + 1
+
+    def valueKeys(self, data):
+        return data.astype(numpy.int64) - self.minValue
+
+    def keyValues(self, keys):
+        return (keys + self.minValue).astype(numpy.float64)
+
+class ZoneQuantileSketch(ZoneKeyCounts):
+    """
+    A mergeable sketch that gives approximate quantiles for each zone
+    with a bounded relative error. Values are counted in logarithmically
+    sized buckets (as in DDSketch), so memory depends on the number 
+    of zones and the spread of the data, not the number of pixels.
+    """
+    def __init__(self, relativeAccuracy=DEFAULT_RELATIVE_ACCURACY):
+        ZoneKeyCounts.__init__(self)
+        self.gamma = (1.0 + relativeAccuracy) / (1.0 - relativeAccuracy)
+        self.logGamma = numpy.log(self.gamma)
+        # range of bucket indices that covers all positive float64 values
+        finfo = numpy.finfo(numpy.float64)
+        self.minIndex = int(numpy.floor(numpy.log(finfo.tiny * finfo.eps) / 
+                            self.logGamma))
+        self.maxIndex = int(numpy.ceil(numpy.log(finfo.max) / self.logGamma))
+        self.nIndexes = self.maxIndex - self.minIndex + 1
+        # keys are negative buckets (largest magnitude first), 
+        # zero, then positive buckets
+        self.nKeysPerZone = 2 * self.nIndexes + 1
+
+    def valueKeys(self, data):
+        data = data.astype(numpy.float64)
+        magnitude = numpy.abs(data)
+        isZero = magnitude == 0
+        magnitude[isZero] = 1
+        index = numpy.ceil(numpy.log(magnitude) / self.logGamma).astype(numpy.int64)
+        index = index.clip(self.minIndex, self.maxIndex)
+
+        keys = numpy.where(data < 0, self.maxIndex - index, 
+                    self.nIndexes + 1 + index - self.minIndex)
+        keys[isZero] = self.nIndexes
+        return keys
+
+    def keyValues(self, keys):
+        isNegative = keys < self.nIndexes
+        index = numpy.where(isNegative, self.maxIndex - keys, 
+                    keys - self.nIndexes - 1 + self.minIndex)
+        values = 2.0 * numpy.power(self.gamma, index.astype(numpy.float64)) / (self.gamma + 1)
+        values[isNegative] *= -1
+        values[keys == self.nIndexes] = 0
+        return values
+
+def zoneStats(clumpFile, dataFile, stats, clumpBand=1, dataBands=None, 
+                    ignoreDataVals=None, percentiles=None, 
+                    approxQuantiles=False, 
+                    relativeAccuracy=DEFAULT_RELATIVE_ACCURACY,
+                    maxMemory=DEFAULT_MAX_MEMORY, tempDir='.'):
+    """
+    Given a file of clumps and a file of data, calculates the requested
+    statistics for the area of each clump value in the data, for all 
+    the requested bands in one read of the files.
+
+    stats is a sequence of statistics to calculate, from:
+        STAT_COUNT, STAT_SUM, STAT_MEAN, STAT_STD, STAT_MIN, 
+        STAT_MAX, STAT_RANGE, STAT_MEDIAN, STAT_PERCENTILES
+    STAT_PERCENTILES needs a sequence of percentiles (0-100)
+    passed as percentiles.
+
+    If dataBands is None does all bands in the dataFile, otherwise
+    pass list of 1-based band indices or a single integer.
+    If dataBands is None or a list, returns list of dictionaries, one
+    per band. Each dictionary is keyed on the statistic and contains an
+    array whose indices go from zero to the maximum clump value, with
+    values for each clump id and zero for clumps with no data. The 
+    STAT_PERCENTILES array has one row per percentile.
+    If dataBands is a single integer, returns one dictionary as above.
+
+    Ignore values(s) may be passed in with the ignoreDataVals parameter.
+    This may be a single value in which case the same is used for all 
+    dataBands, or a sequence the same length as dataValues.
+
+    The moment statistics are accumulated with numpy.bincount. The 
+    median and percentiles need all the values and are exact unless 
+    approxQuantiles is True. In that case they come from a sketch for 
+    each zone with the given relativeAccuracy. For exact values, once 
+    more than maxMemory bytes are held, values are spilled to temporary 
+    files in tempDir.
+    """
+    for stat in stats:
+        if stat not in MOMENT_STATS and stat not in QUANTILE_STATS:
+            raise ValueError('Unknown statistic %s' % stat)
+    if STAT_PERCENTILES in stats and percentiles is None:
+        raise ValueError('must specify percentiles with STAT_PERCENTILES')
+
+    # median goes in with the other percentiles then taken out again
+    allPercentiles = []
+    if STAT_MEDIAN in stats:
+        allPercentiles.append(50)
+    if STAT_PERCENTILES in stats:
+        allPercentiles.extend(percentiles)
+    needMoments = len([stat for stat in stats if stat in MOMENT_STATS]) > 0
+    needMinMax = (STAT_MIN in stats or STAT_MAX in stats or 
+                    STAT_RANGE in stats)
+
+    fileDict = {'clumps':clumpFile, 'data':dataFile}
+
+    origdataBands = dataBands # so we know whether to return list or tuple
+    if isinstance(dataBands, int):
+        dataBands = [dataBands] # treat as list for now
+
+    # accumulators for each band
+    # created on the first block when we know how many bands
+    momentsList = None
+    quantilesList = None
+    maxidx = 0
+
+    try:
+        # red thru the images
+        reader = ImageReader(fileDict)
+        for (info, blocks) in reader:
+            # get the data for the specified bands and flatten it
+            clumps = blocks['clumps'][clumpBand-1].ravel()
+
+            if dataBands is None:
+                # now we know how many bands there are for the default list
+                dataBands = range(1, blocks['data'].shape[0]+1)
+
+            if momentsList is None:
+                if ignoreDataVals is not None and numpy.isscalar(ignoreDataVals):
+                    # make list same size as dataBands
+                    ignoreDataVals = [ignoreDataVals] * len(dataBands)
+
+                momentsList = []
+                quantilesList = []
+                xsize, ysize = info.getTotalSize()
+                for dataBand in dataBands:
+                    if needMoments:
+                        momentsList.append(ZoneMoments(needMinMax))
+                    else:
+                        momentsList.append(None)
+
+                    if len(allPercentiles) == 0:
+                        quantilesList.append(None)
+                    elif approxQuantiles:
+                        quantilesList.append(ZoneQuantileSketch(relativeAccuracy))
+                    else:
+                        quantilesList.append(ZoneValueStore(
+                            maxMemory // len(dataBands), tempDir, xsize * ysize))
+
+            for idx, dataBand in enumerate(dataBands):
+
+                data = blocks['data'][dataBand-1].ravel()
+                bandClumps = clumps
+
+                # if we are ignoring values then drop those pixels
+                if ignoreDataVals is not None:
+                    mask = data != ignoreDataVals[idx]
+                    data = data.compress(mask)
+                    bandClumps = clumps.compress(mask)
+
+                if bandClumps.size == 0:
+                    continue
+                maxidx = max(maxidx, int(bandClumps.max()) + 1)
+
+                if momentsList[idx] is not None:
+                    momentsList[idx].update(bandClumps, data)
+                if quantilesList[idx] is not None:
+                    quantilesList[idx].update(bandClumps, data)
+
+        resultList = []
+        for idx, dataBand in enumerate(dataBands):
+            results = {}
+            if momentsList[idx] is not None:
+                results.update(momentsList[idx].getStats(maxidx, stats))
+
+            if quantilesList[idx] is not None:
+                quantiles = quantilesList[idx].getQuantiles(maxidx, 
+                                    allPercentiles)
+                if STAT_MEDIAN in stats:
+                    results[STAT_MEDIAN] = quantiles[0]
+                    quantiles = quantiles[1:]
+                if STAT_PERCENTILES in stats:
+                    results[STAT_PERCENTILES] = quantiles
+
+            resultList.append(results)
+
+    finally:
+        if quantilesList is not None:
+            for quantileAcc in quantilesList:
+                if quantileAcc is not None:
+                    quantileAcc.close()
             
     if isinstance(origdataBands, int):
         return resultList[0] # only one item
     else:
         return resultList
-        
-    
-                    